@@ -44,6 +44,10 @@ class TetrisAction(IAction):
             TetrisActionType.ROTATE: world.rotate_figure,
         }[self._action_type]()
 
+    @property
+    def places_figure(self) -> bool:
+        return self._action_type is TetrisActionType.ALL_WAY_DOWN
+
     def __repr__(self):
         return str(self._action_type)
 
@@ -56,6 +60,9 @@ class MoveToPosition(HighLevelAction):
     figure: Figure
     x: int
 
+    def apply(self, world):
+        world.place_figure(self.figure, self.x)
+
     def unroll(self, world) -> List[IAction]:
         return [TetrisAction(action_type) for action_type in self._plan(world, self.figure, self.x)]
 
@@ -67,11 +74,8 @@ class MoveToPosition(HighLevelAction):
 
     @classmethod
     def _fit_figure_orientation(cls, world: World, figure: Figure) -> Iterator[TetrisActionType]:
-        if world.figure != figure:
-            figure_copy: Figure = world.figure.copy()
-            while figure_copy != figure:
-                yield TetrisActionType.ROTATE
-                figure_copy.rotate_clockwise()
+        rotations_count = world.figure.orientation.rotations_to(figure.orientation)
+        yield from (TetrisActionType.ROTATE for _ in range(rotations_count))
 
     @classmethod
     def _fit_figure_location(cls, world: World, x: int) -> Iterator[TetrisActionType]:
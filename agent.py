@@ -1,17 +1,27 @@
+import heapq
+import time
 from multiprocessing import Pool
-from typing import List, Iterator, Callable, Optional
+from typing import Any, Dict, List, Iterator, Callable, Optional, Tuple
 
 import numpy as np
 
 from action import TetrisAction, MoveToPosition
-from state_tree import StateTree, Node, SimpleEvaluationStrategy, ParallelEvaluationStrategy
-from world import World
+from metrics import DecisionMetrics, EXPANSION, PROBABILISTIC
+from state_tree import (
+    StateTree, Node, SimpleEvaluationStrategy, ParallelEvaluationStrategy, EvaluationStrategy, IFringe,
+    TranspositionTable, SharedMemoryEvaluationStrategy
+)
+from world import World, Figure, Orientation
 
 
 def avg(elements: List):
     return sum(elements) / len(elements)
 
 
+def weighted_avg(elements: List, weights: List):
+    return sum(weight * element for element, weight in zip(elements, weights)) / sum(weights)
+
+
 def random_utility(_) -> float:
     return float(np.random.randint(0, 10000))
 
@@ -30,66 +40,332 @@ def trivial_utility(world: World) -> float:
 
 
 class IAgent:
+    """
+    The agents supporting metrics call the attached hook with the DecisionMetrics of every decision.
+    """
+    metrics_hook: Optional[Callable[[DecisionMetrics], None]] = None
+
     def choose_action(self, world) -> TetrisAction:
         raise NotImplementedError
 
+    def attach_metrics(self, hook: Optional[Callable[[DecisionMetrics], None]]) -> None:
+        """
+        Sets the hook receiving the metrics of the decisions, None detaches it. See metrics.MetricsRecorder.
+        """
+        self.metrics_hook = hook
+
+    def plan_state(self) -> Any:
+        """
+        What the agent needs to go on with a game after restore_plan_state, see checkpoint.py.
+        """
+        return None
+
+    def restore_plan_state(self, state: Any) -> None:
+        pass
+
+
+class ActionCodes:
+    """
+    Interned placements: every placement is a single MoveToPosition instance with a small int code,
+    which the nodes store instead of the action. The codes are only valid in the process that made them.
+    """
+    def __init__(self):
+        self.actions: List[MoveToPosition] = []
+        self._placements: Dict[Tuple[Orientation, int], List[Tuple[int, MoveToPosition]]] = {}
+        self._codes: Dict[Tuple[Orientation, int], int] = {}
+
+    def placements(self, orientation: Orientation, width: int) -> List[Tuple[int, MoveToPosition]]:
+        """
+        Codes and actions of the placements of a figure in the orientation on a board of the width.
+        """
+        key = (orientation, width)
+        placements = self._placements.get(key)
+        if placements is None:
+            placements = self._placements[key] = []
+            for figure in Figure.from_orientation(orientation).possible_orientations():
+                for figure_x in range(width - figure.width() + 1):
+                    code = self.code(MoveToPosition(figure, figure_x))
+                    placements.append((code, self.actions[code]))
+        return placements
+
+    def code(self, action: MoveToPosition) -> int:
+        key = (action.figure.orientation, action.x)
+        code = self._codes.get(key)
+        if code is None:
+            code = self._codes[key] = len(self.actions)
+            self.actions.append(action)
+        return code
+
+
+action_codes = ActionCodes()
+
 
 def possible_actions(world: World) -> Iterator[MoveToPosition]:
-    for figure in world.figure.possible_orientations():
-        for figure_x in range(world.board.width() - figure.width() + 1):
-            yield MoveToPosition(figure, figure_x)
+    for _, action in action_codes.placements(world.figure.orientation, world.board.width()):
+        yield action
 
 
 class TetrisWorldNode(Node):
-    def __init__(self, world: World, path: Optional[List[Node]] = None):
-        super().__init__(path)
+    """
+    The action of a node is the code of its placement, see ActionCodes, and path gives the placements.
+    """
+    __slots__ = ("world", "children")
+
+    def __init__(self, world: Optional[World], parent: Optional['TetrisWorldNode'] = None, action: Optional[int] = None):
+        super().__init__(parent, action)
         self.world = world
+        self.children: Optional[List[TetrisWorldNode]] = None
+
+    @property
+    def path(self) -> List[MoveToPosition]:
+        return [action_codes.actions[code] for code in super().path]
+
+    def __getstate__(self):
+        action = action_codes.actions[self.action] if self.action is not None else None
+        return self.world, self.children, self.parent, action, self._depth
+
+    def __setstate__(self, state):
+        self.world, self.children, self.parent, action, self._depth = state
+        self.action = action_codes.code(action) if action is not None else None
+
+    def reroot(self, world: World) -> bool:
+        """
+        Makes the node the root of a new search from the world, which is the world of the node
+        after its path was played and the next figure became known.
+        The children kept from the previous search move one level up and get the next figure.
+        Returns False if the world is not the one the node predicted.
+        """
+        if not (
+                self.world.figure == world.figure
+                and np.array_equal(self.world.board.map_fragment, world.board.map_fragment)
+        ):
+            return False
+        self.world = world
+        self.parent = self.action = None
+        self._set_depth(0)
+        for child in self.children or []:
+            child.world.figure = world.next_figure.copy()
+        return True
+
+    def _set_depth(self, depth: int) -> None:
+        self._depth = depth
+        for child in self.children or []:
+            child._set_depth(depth + 1)
 
 
 class TetrisStateTree(StateTree):
+    """
+    With in_place=True the tree is traversed depth-first on a single copy of the root world,
+    placing figures and reverting the placements instead of copying the world for every child.
+    All the nodes share that world, so a leaf has to be evaluated before the next one is requested,
+    which SimpleEvaluationStrategy does. With copy_root=False the root world itself is used instead of a copy,
+    for callers owning it; it is the same again once the traversal is over.
+    With keep_children=True the expanded nodes keep their children, and the children already kept
+    by a node are not expanded again, see TetrisWorldNode.reroot.
+    Otherwise the expanded nodes release their worlds, which the children reaching their parents don't need.
+    """
+    def __init__(
+            self, root_node: TetrisWorldNode, evaluation_strategy: EvaluationStrategy,
+            fringe_type: Optional[Callable[[], IFringe]] = None, in_place: bool = False, keep_children: bool = False,
+            copy_root: bool = True
+    ):
+        super().__init__(root_node, evaluation_strategy, fringe_type)
+        self.in_place = in_place
+        self.copy_root = copy_root
+        self.keep_children = keep_children
+
+    def leaves(self, depth: int) -> Iterator[Node]:
+        if not self.in_place:
+            yield from super().leaves(depth)
+            return
+        root_node = self.root_node
+        if self.copy_root:
+            root_node = TetrisWorldNode(root_node.world.deepcopy(), root_node.parent, root_node.action)
+        yield from self._in_place_leaves(root_node, depth)
+
+    def _in_place_leaves(self, node: TetrisWorldNode, depth: int) -> Iterator[Node]:
+        if node.depth() == depth:
+            yield node
+            return
+        world = node.world
+        metrics = self.evaluation_strategy.metrics
+        if metrics is not None:
+            metrics.add_expansion(node.depth())
+        for code, action in action_codes.placements(world.figure.orientation, world.board.width()):
+            if metrics is None:
+                record = world.place_figure_reversibly(action.figure, action.x)
+            else:
+                start = time.perf_counter()
+                record = world.place_figure_reversibly(action.figure, action.x)
+                metrics.add_time(EXPANSION, time.perf_counter() - start)
+            yield from self._in_place_leaves(TetrisWorldNode(world, node, code), depth)
+            world.revert_placement(record)
 
     def expand_node(self, node: TetrisWorldNode) -> Iterator[Node]:
-        for action in possible_actions(node.world):
-            path = node.path + [action]
-            yield TetrisWorldNode(action.apply_to_copy(node.world), path)
+        if node.children is not None:
+            yield from node.children
+            return
+        children = (
+            TetrisWorldNode(action.apply_to_copy(node.world), node, code)
+            for code, action in action_codes.placements(node.world.figure.orientation, node.world.board.width())
+        )
+        if self.keep_children:
+            node.children = list(children)
+            yield from node.children
+        else:
+            yield from children
+            node.world = None
+
+
+def contour_key(world: World, clip: int, max_height: int) -> Optional[Tuple]:
+    """
+    The differences between the heights of neighbouring columns, clipped to [-clip, clip],
+    with the figure, its position and the next figure.
+    None if the board has holes or a column higher than max_height: without holes and full rows,
+    the lowest column is empty and the differences give the whole board, so moves chosen for the key
+    are the ones a search would choose, up to the clipping.
+    """
+    fringe = world.board.fringe()
+    heights = [world.board.height() - top for top in fringe]
+    if max(heights) > max_height or np.count_nonzero(world.board.map_fragment) != sum(heights):
+        return None
+    contour = tuple(max(-clip, min(clip, right - left)) for left, right in zip(heights, heights[1:]))
+    return contour, world.figure.orientation, world.figure_x, world.figure_y, world.next_figure.orientation
 
 
 class ReflexiveHierarchicalAgent(IAgent):
     """
     Chooses the action with highest utility.
     Returns only the first one and recalculates when the new figure is known.
+    With transposition_table_capacity > 0, the utilities are cached by board across the decisions.
     """
-    def __init__(self, utility: Callable):
+    def __init__(self, utility: Callable, transposition_table_capacity: int = 0):
         self._plan: List[TetrisAction] = []
+        self._kept_node: Optional[TetrisWorldNode] = None
         self.utility = utility
-        self.evaluation_strategy = SimpleEvaluationStrategy(self.utility)
+        self.transposition_table = (
+            TranspositionTable(transposition_table_capacity) if transposition_table_capacity > 0 else None
+        )
+        self.evaluation_strategy = SimpleEvaluationStrategy(self.utility, self.transposition_table)
 
     def choose_action(self, world) -> TetrisAction:
         if not self._plan:
             self.extent_plan(world)
         return self._plan.pop(0)
 
+    def plan_state(self) -> Tuple[List[TetrisAction], Optional[TetrisWorldNode]]:
+        # the kept subtree saves the expansions, and with them the figures drawn, of the next search
+        return list(self._plan), self._kept_node
+
+    def restore_plan_state(self, state: Tuple[List[TetrisAction], Optional[TetrisWorldNode]]) -> None:
+        plan, self._kept_node = state
+        self._plan = list(plan)
+
     def extent_plan(self, world):
-        self._plan.extend(self._new_plan(world))
+        if self.metrics_hook is None:
+            self._plan.extend(self._new_plan(world))
+        else:
+            self._plan.extend(self._measured_plan(world))
+
+    def _measured_plan(self, world) -> List[TetrisAction]:
+        """
+        New plan, with the metrics attached to the evaluation strategies for the time of the search.
+        """
+        metrics = DecisionMetrics(type(self).__name__)
+        strategies = self._evaluation_strategies()
+        caches = self._caches()
+        cache_counts = [(cache.hits, cache.misses) for cache in caches]
+        for strategy in strategies:
+            strategy.metrics = metrics
+        start = time.perf_counter()
+        try:
+            plan = self._new_plan(world)
+        finally:
+            for strategy in strategies:
+                strategy.metrics = None
+        metrics.wall_time = time.perf_counter() - start
+        for cache, (hits, misses) in zip(caches, cache_counts):
+            metrics.cache_hits += cache.hits - hits
+            metrics.cache_misses += cache.misses - misses
+        self.metrics_hook(metrics)
+        return plan
+
+    def _evaluation_strategies(self) -> List[EvaluationStrategy]:
+        return [self.evaluation_strategy]
+
+    def _caches(self) -> List[TranspositionTable]:
+        return [cache for cache in (self.transposition_table,) if cache is not None]
+
+    def _search_root(self, world) -> TetrisWorldNode:
+        """
+        The child kept from the previous search if the world is the one it predicted, a new root otherwise.
+        """
+        node, self._kept_node = self._kept_node, None
+        if node is not None and node.reroot(world):
+            return node
+        return TetrisWorldNode(world)
+
+    def _keep_subtree(self, root_node: TetrisWorldNode, action: MoveToPosition):
+        """
+        Keeps the child of the root reached by the chosen action, together with its children,
+        for the next search. The rest of the tree is released.
+        """
+        self._kept_node = next((child for child in root_node.children or [] if child.path[0] is action), None)
+        root_node.children = None
+        if self._kept_node is not None:
+            self._kept_node.parent = None
 
     def _new_plan(self, world) -> List[TetrisAction]:
         state_tree = TetrisStateTree(
             TetrisWorldNode(world),
-            self.evaluation_strategy
+            self.evaluation_strategy,
+            in_place=True,
         )
         return state_tree.max(depth_limit=1).path[0].unroll(world)
 
 
 class PlanningTwoMovesHierarchicalAgent(ReflexiveHierarchicalAgent):
     """
-    Chooses the combination of 2 moves with highest utility
+    Chooses the combination of 2 moves with highest utility.
+    With reuse_subtree=True, the placements of the next figure searched for the chosen move are kept
+    and reused by the next decision, otherwise the search is done in place. Reusing saves only the expansion
+    of the first ply and keeps the worlds of the kept placements alive between the decisions, so it is off by default.
+    With contour_cache_capacity > 0, the chosen moves are cached by the contour of the board,
+    see contour_key, and the two known figures, and a cached move is played without a search.
+    Like the transposition table, the cache requires a utility depending on the board only.
     """
+    def __init__(
+            self, utility: Callable, transposition_table_capacity: int = 0, reuse_subtree: bool = False,
+            contour_cache_capacity: int = 0, contour_clip: int = 3, contour_max_height: int = 8
+    ):
+        super().__init__(utility, transposition_table_capacity)
+        self.reuse_subtree = reuse_subtree
+        self.contour_cache = TranspositionTable(contour_cache_capacity) if contour_cache_capacity > 0 else None
+        self.contour_clip = contour_clip
+        self.contour_max_height = contour_max_height
+
     def _new_plan(self, world) -> List[TetrisAction]:
-        state_tree = TetrisStateTree(
-            TetrisWorldNode(world),
-            SimpleEvaluationStrategy(self.utility)
-        )
-        return state_tree.max(depth_limit=2).path[0].unroll(world)
+        key = None
+        if self.contour_cache is not None:
+            key = contour_key(world, self.contour_clip, self.contour_max_height)
+            action = self.contour_cache.get(key) if key is not None else None
+            if action is not None:
+                self._kept_node = None
+                return action.unroll(world)
+        action = self._searched_action(world)
+        if key is not None:
+            self.contour_cache.put(key, action)
+        return action.unroll(world)
+
+    def _searched_action(self, world) -> MoveToPosition:
+        if not self.reuse_subtree:
+            state_tree = TetrisStateTree(TetrisWorldNode(world), self.evaluation_strategy, in_place=True)
+            return state_tree.max(depth_limit=2).path[0]
+
+        state_tree = TetrisStateTree(self._search_root(world), self.evaluation_strategy, keep_children=True)
+        action = state_tree.max(depth_limit=2).path[0]
+        self._keep_subtree(state_tree.root_node, action)
+        return action
 
 
 class ProbabilisticPlanningHierarchicalAgent(ReflexiveHierarchicalAgent):
@@ -98,36 +374,98 @@ class ProbabilisticPlanningHierarchicalAgent(ReflexiveHierarchicalAgent):
     Probabilistic utility is calculated as average utility over possible next figures
     that are not known yet.
     Very slow even with multiprocessing.
+    The transposition table caches probabilistic utilities.
+    With reuse_subtree=True, the placements searched for the chosen move are reused by the next decision.
+    With root_parallel=True, the moves of the current figure are split between the processes of the pool,
+    each process searching the whole subtree of its moves and returning only their best values.
+    The best utility for a board and a next figure is cached, so equal boards are expanded once per figure.
     """
-    def __init__(self, utility: Callable, processes: int = 10):
-        super().__init__(utility)
-        self.pool = Pool(processes=processes) if processes > 0 else None
-        self.evaluation_strategy = ParallelEvaluationStrategy(self._probabilistic_utility)
+    def __init__(
+            self, utility: Callable, processes: int = 10, transposition_table_capacity: int = 2 ** 14,
+            reuse_subtree: bool = False, root_parallel: bool = False, expectation_cache_capacity: int = 2 ** 16
+    ):
+        super().__init__(utility, transposition_table_capacity)
+        self.reuse_subtree = reuse_subtree
+        self.root_parallel = root_parallel
+        self.expectation_cache = (
+            TranspositionTable(expectation_cache_capacity) if expectation_cache_capacity > 0 else None
+        )
+        self.pool = Pool(processes=processes) if processes > 0 and root_parallel else None
+        if processes > 0:
+            self.evaluation_strategy = SharedMemoryEvaluationStrategy(
+                self._probabilistic_utility, processes, self.transposition_table
+            )
+        else:
+            self.evaluation_strategy = ParallelEvaluationStrategy(
+                self._probabilistic_utility, transposition_table=self.transposition_table
+            )
+        self.evaluation_strategy.metrics_phase = PROBABILISTIC
 
     def __getstate__(self):
-        return self._plan, self.utility
+        expectation_cache_capacity = self.expectation_cache.capacity if self.expectation_cache is not None else 0
+        return self._plan, self.utility, expectation_cache_capacity
 
     def __setstate__(self, state):
-        self._plan, self.utility = state
+        self._plan, self.utility, expectation_cache_capacity = state
+        self.expectation_cache = (
+            TranspositionTable(expectation_cache_capacity) if expectation_cache_capacity > 0 else None
+        )
+
+    def _caches(self) -> List[TranspositionTable]:
+        return super()._caches() + [cache for cache in (self.expectation_cache,) if cache is not None]
 
     def _probabilistic_utility(self, world: World) -> float:
         utilities_for_next_figure = []
         eval_strategy = SimpleEvaluationStrategy(self.utility)
+        # copied before hashing, so expanding the copy does not update a hash nobody reads
+        world_copy = world.deepcopy()
+        board_hash = world.board.zobrist_hash() if self.expectation_cache is not None else None
         for figure in world.figure_factory.figures:
-            world_copy = world.deepcopy()
-            world_copy.figure = figure
-            state_tree = TetrisStateTree(TetrisWorldNode(world_copy), eval_strategy)
-            max_utility = max((value[0] for node, value in eval_strategy.node_values(state_tree.leaves(depth=1))))
+            max_utility = None
+            if self.expectation_cache is not None:
+                max_utility = self.expectation_cache.get((board_hash, figure.orientation))
+            if max_utility is None:
+                world_copy.figure = figure
+                state_tree = TetrisStateTree(
+                    TetrisWorldNode(world_copy), eval_strategy, in_place=True, copy_root=False
+                )
+                max_utility = max(
+                    (value[0] for node, value in eval_strategy.node_values(state_tree.leaves(depth=1)))
+                )
+                if self.expectation_cache is not None:
+                    self.expectation_cache.put((board_hash, figure.orientation), max_utility)
             utilities_for_next_figure.append(max_utility)
-        # add weights if the distribution is not uniform
-        return avg(utilities_for_next_figure)
+        return weighted_avg(utilities_for_next_figure, world.figure_factory.figure_weights())
 
     def _new_plan(self, world) -> List[TetrisAction]:
+        if self.root_parallel and self.pool:
+            return self._root_parallel_plan(world)
         state_tree = TetrisStateTree(
-            TetrisWorldNode(world),
+            self._search_root(world),
             self.evaluation_strategy,
+            keep_children=self.reuse_subtree,
         )
-        return state_tree.max(depth_limit=2).path[0].unroll(world)
+        action = state_tree.max(depth_limit=2).path[0]
+        self._keep_subtree(state_tree.root_node, action)
+        return action.unroll(world)
+
+    def _root_parallel_plan(self, world) -> List[TetrisAction]:
+        actions = list(possible_actions(world))
+        metrics = self.evaluation_strategy.metrics
+        start = time.perf_counter()
+        values = self.pool.starmap(self._best_probabilistic_value, [(world, action) for action in actions], 1)
+        if metrics is not None:
+            metrics.pool_round_trips += 1
+            metrics.add_time(PROBABILISTIC, time.perf_counter() - start)
+        return max(zip(actions, values), key=lambda e: e[1])[0].unroll(world)
+
+    def _best_probabilistic_value(self, world, action: MoveToPosition) -> float:
+        """
+        Highest probabilistic utility among the placements of the next figure after the action.
+        """
+        eval_strategy = SimpleEvaluationStrategy(self._probabilistic_utility)
+        state_tree = TetrisStateTree(TetrisWorldNode(action.apply_to_copy(world)), eval_strategy)
+        return max(value for node, value in eval_strategy.node_values(state_tree.leaves(depth=1)))
 
 
 class LimitedProbabilisticPlanningHierarchicalAgent(ProbabilisticPlanningHierarchicalAgent):
@@ -136,23 +474,163 @@ class LimitedProbabilisticPlanningHierarchicalAgent(ProbabilisticPlanningHierarc
     Calculates a set of moves with highest utility the same way PlanningTwoMovesHierarchicalAgent does.
     Then chooses the best move using probabilistic utility like ProbabilisticPlanningHierarchicalAgent.
     Fast enough to work real-time, and performs significantly better than PlanningTwoMovesHierarchicalAgent.
+    Only the best combination for every first move is a candidate. Of the max_candidates best ones,
+    those with a value within candidate_value_gap of the best value, relative to it, are evaluated
+    probabilistically, but at least min_candidates.
     """
-    def __init__(self, utility: Callable, processes: int = 10):
-        super().__init__(utility, processes)
+    def __init__(
+            self, utility: Callable, processes: int = 10, transposition_table_capacity: int = 2 ** 14,
+            reuse_subtree: bool = False, expectation_cache_capacity: int = 2 ** 16,
+            max_candidates: int = 10, min_candidates: int = 2, candidate_value_gap: float = 0.01
+    ):
+        super().__init__(
+            utility, processes, transposition_table_capacity, reuse_subtree,
+            expectation_cache_capacity=expectation_cache_capacity,
+        )
+        self.max_candidates = max_candidates
+        self.min_candidates = min_candidates
+        self.candidate_value_gap = candidate_value_gap
+        # the probabilistic strategy of the parent, in the shared memory workers if there are processes
+        self.probabilistic_evaluation_strategy = self.evaluation_strategy
         self.evaluation_strategy = ParallelEvaluationStrategy(utility)
-        self.probabilistic_evaluation_strategy = ParallelEvaluationStrategy(self._probabilistic_utility, self.pool)
+
+    def _evaluation_strategies(self) -> List[EvaluationStrategy]:
+        return [self.evaluation_strategy, self.probabilistic_evaluation_strategy]
 
     def _new_plan(self, world) -> List[TetrisAction]:
         state_tree = TetrisStateTree(
-            TetrisWorldNode(world),
+            self._search_root(world),
             self.evaluation_strategy,
+            keep_children=self.reuse_subtree,
         )
-        nodes_and_values = self.evaluation_strategy.node_values(state_tree.leaves(depth=2))
-        top_rated_nodes_count = 10
-        top_rated_nodes = [
-            node for node, value in sorted(nodes_and_values, key=lambda e: e[1], reverse=True)[:top_rated_nodes_count]
-        ]
-        return max(
-            self.probabilistic_evaluation_strategy.node_values(top_rated_nodes),
+        action = max(
+            self.probabilistic_evaluation_strategy.node_values(self._candidates(state_tree)),
             key=lambda e: e[1],
-        )[0].path[0].unroll(world)
+        )[0].path[0]
+        self._keep_subtree(state_tree.root_node, action)
+        return action.unroll(world)
+
+    def _candidates(self, state_tree: TetrisStateTree) -> List[TetrisWorldNode]:
+        """
+        The leaves are evaluated one first move at a time, and the best leaf of every first move
+        goes through a heap holding the max_candidates best ones, ties going to the earlier move.
+        With reuse_subtree=True, the first moves leaving the heap release their children.
+        """
+        best_leaves = []
+        for order, child in enumerate(state_tree.expanded(state_tree.root_node)):
+            subtree = TetrisStateTree(child, self.evaluation_strategy, keep_children=self.reuse_subtree)
+            best_leaf = max(
+                self.evaluation_strategy.node_values(subtree.leaves(depth=2)), key=lambda e: e[1], default=None
+            )
+            if best_leaf is None:
+                continue
+            leaf, value = best_leaf[0], utility_value(best_leaf[1])
+            if len(best_leaves) < self.max_candidates:
+                heapq.heappush(best_leaves, (value, -order, leaf))
+            else:
+                _, _, dropped_leaf = heapq.heappushpop(best_leaves, (value, -order, leaf))
+                # only the subtrees of the candidates are kept
+                dropped_leaf.parent.children = None
+
+        ranked = sorted(best_leaves, reverse=True)
+        if not ranked:
+            return []
+        best_value = ranked[0][0]
+        return [
+            leaf for index, (value, _, leaf) in enumerate(ranked)
+            if index < self.min_candidates
+            or best_value - value <= self.candidate_value_gap * abs(best_value)
+        ]
+
+
+class SearchTimeout(Exception):
+    pass
+
+
+class AnytimeExpectimaxAgent(ReflexiveHierarchicalAgent):
+    """
+    Expectimax search limited by wall-clock time per decision.
+    The search is deepened ply by ply: the first two plies place the current and the next figure,
+    every further ply averages over the possible figures and places the figure.
+    The best move of the deepest finished iteration is returned when the time is up.
+    An unfinished iteration is used if it has already evaluated the best move of the previous one,
+    since the moves are searched in the order of their previous values.
+    The transposition table is off by default: with a cheap utility, keeping the board hashes up to date
+    costs more leaves per decision than the few hits save.
+    """
+    def __init__(
+            self, utility: Callable, time_budget: float = 0.08, max_depth: int = 4,
+            transposition_table_capacity: int = 0
+    ):
+        super().__init__(utility, transposition_table_capacity)
+        self.time_budget = time_budget
+        self.max_depth = max_depth
+        self.last_search_depth = 0
+        self._deadline = 0.
+
+    def _new_plan(self, world) -> List[TetrisAction]:
+        self._deadline = time.perf_counter() + self.time_budget
+        actions = list(possible_actions(world))
+        best_action = actions[0]
+        self.last_search_depth = 0
+        for depth in range(1, self.max_depth + 1):
+            values = []
+            if self.evaluation_strategy.metrics is not None:
+                self.evaluation_strategy.metrics.add_expansion(0)
+            try:
+                search_world = world.deepcopy()
+                for action in actions:
+                    values.append((self._action_value(search_world, action, depth - 1, 1), action))
+            except SearchTimeout:
+                if values:
+                    best_action = max(values, key=lambda e: e[0])[1]
+                break
+            actions = [action for _, action in sorted(values, key=lambda e: e[0], reverse=True)]
+            best_action = actions[0]
+            self.last_search_depth = depth
+        if self.evaluation_strategy.metrics is not None:
+            self.evaluation_strategy.metrics.search_depth = self.last_search_depth
+        return best_action.unroll(world)
+
+    def _action_value(self, world: World, action: MoveToPosition, depth: int, ply: int) -> float:
+        metrics = self.evaluation_strategy.metrics
+        if metrics is None:
+            record = world.place_figure_reversibly(action.figure, action.x)
+        else:
+            start = time.perf_counter()
+            record = world.place_figure_reversibly(action.figure, action.x)
+            metrics.add_time(EXPANSION, time.perf_counter() - start)
+        if depth == 0:
+            value = self._leaf_value(world)
+        elif ply < 2:
+            value = self._max_value(world, depth, ply + 1)
+        else:
+            value = self._expected_value(world, depth, ply + 1)
+        world.revert_placement(record)
+        return value
+
+    def _max_value(self, world: World, depth: int, ply: int) -> float:
+        if self.evaluation_strategy.metrics is not None:
+            self.evaluation_strategy.metrics.add_expansion(ply - 1)
+        return max(self._action_value(world, action, depth - 1, ply) for action in list(possible_actions(world)))
+
+    def _expected_value(self, world: World, depth: int, ply: int) -> float:
+        figure = world.figure
+        values = []
+        for possible_figure in world.figure_factory.figures:
+            world.figure = possible_figure
+            values.append(self._max_value(world, depth, ply))
+        world.figure = figure
+        return weighted_avg(values, world.figure_factory.figure_weights())
+
+    def _leaf_value(self, world: World) -> float:
+        if time.perf_counter() > self._deadline:
+            raise SearchTimeout()
+        return utility_value(self.evaluation_strategy.value(world))
+
+
+def utility_value(value) -> float:
+    """
+    Utility returns the value together with the feature values.
+    """
+    return value[0] if isinstance(value, tuple) else value
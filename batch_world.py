@@ -0,0 +1,273 @@
+"""
+Many tetris worlds advanced in lockstep, for simulations without rendering.
+"""
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+
+from utility import BatchUtility
+from world import Config, FigureFactory, OrientationTable, World, default_figure_factory
+
+MAX_FIGURE_HEIGHT = 4
+
+
+class FigurePlacements:
+    """
+    The placements of a figure in the order of agent.possible_actions:
+    orientations in the order of their rotation cycle starting from the spawn orientation,
+    so the orientation index is the number of rotations, and columns from left to right.
+    The row masks of every orientation with its left side at every column are precomputed.
+    """
+    def __init__(self, figure_factory: FigureFactory, figure_index: int, columns: int):
+        orientations = OrientationTable.of(figure_factory.figures).orientations[figure_index]
+        widths = np.array([orientation.width for orientation in orientations])
+        self.masks = np.zeros((len(orientations), columns, MAX_FIGURE_HEIGHT), dtype=np.int64)
+        for orientation_index, orientation in enumerate(orientations):
+            for x in range(columns - orientation.width + 1):
+                self.masks[orientation_index, x, :orientation.height] = [mask << x for mask in orientation.row_masks]
+        self.fits = np.arange(columns) <= columns - widths[:, np.newaxis]
+        self.orientation_indices = np.concatenate(
+            [np.full(columns - width + 1, orientation_index) for orientation_index, width in enumerate(widths)]
+        )
+        self.xs = np.concatenate([np.arange(columns - width + 1) for width in widths])
+        spawn_x, _ = World.new_figure_coordinates(columns)
+        self.spawn_masks = self.masks[:, spawn_x]
+
+    def __len__(self):
+        return len(self.xs)
+
+
+class BatchWorld:
+    """
+    Games of the same size held in one array: boards[k, r] is row r of game k as an integer bitmask,
+    bit c being column c, like in BitBoard. Figures are indices into the figures of the figure factory.
+    Placing a figure at a column gives the same board as World.place_figure, including the columns
+    that can't be reached from the spawn position. Finished games stay as they are.
+    actions counts the actions of every game like simulate_game does, moves counts the placed figures.
+    With figure_sequences of shape (games, length), game k gets the figures of figure_sequences[k] in order,
+    starting over when they run out, otherwise the figures are drawn from the figure factory.
+    """
+    def __init__(
+            self, boards: np.ndarray, columns: int, figures: np.ndarray, next_figures: np.ndarray,
+            figure_factory: FigureFactory = default_figure_factory, figure_sequences: Optional[np.ndarray] = None
+    ):
+        self.boards = boards
+        self.columns = columns
+        self.figures = figures
+        self.next_figures = next_figures
+        self.figure_factory = figure_factory
+        self.figure_sequences = figure_sequences
+        self.actions = np.zeros(len(boards), dtype=int)
+        self.moves = np.zeros(len(boards), dtype=int)
+        self.finished = np.zeros(len(boards), dtype=bool)
+        self._full_row = (1 << columns) - 1
+        self._placements: Dict[int, FigurePlacements] = {}
+
+    @classmethod
+    def from_config(
+            cls, config: Config, games_count: int, figure_factory: FigureFactory = default_figure_factory,
+            figure_sequences: Optional[np.ndarray] = None
+    ):
+        if figure_sequences is not None:
+            figures = figure_sequences[:, 0].copy()
+            next_figures = figure_sequences[:, 1 % figure_sequences.shape[1]].copy()
+        else:
+            figures = figure_factory.next_indices(games_count)
+            next_figures = figure_factory.next_indices(games_count)
+        return cls(
+            np.zeros((games_count, config.ROWS), dtype=np.int64), config.COLS, figures, next_figures,
+            figure_factory, figure_sequences,
+        )
+
+    def placements(self, figure_index: int) -> FigurePlacements:
+        if figure_index not in self._placements:
+            self._placements[figure_index] = FigurePlacements(self.figure_factory, figure_index, self.columns)
+        return self._placements[figure_index]
+
+    def active_games(self) -> np.ndarray:
+        return np.flatnonzero(~self.finished)
+
+    def expand(self, boards: np.ndarray, figures: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        The boards after every placement of the figure of every given board,
+        and the index of the board every one of them comes from.
+        They are ordered by that index, the placements of a board in the order of agent.possible_actions.
+        """
+        children = []
+        parents = []
+        for figure_index in np.unique(figures):
+            indices = np.flatnonzero(figures == figure_index)
+            placed = self._place_everywhere(boards[indices], self.placements(figure_index))
+            children.append(placed.reshape(-1, boards.shape[1]))
+            parents.append(np.repeat(indices, placed.shape[1]))
+        children = np.concatenate(children)
+        parents = np.concatenate(parents)
+        order = np.argsort(parents, kind='stable')
+        return children[order], parents[order]
+
+    def _place_everywhere(self, boards: np.ndarray, placements: FigurePlacements) -> np.ndarray:
+        """
+        Boards of shape (n, placements, rows): the figure is rotated at the spawn position,
+        moved towards the column until it is blocked and dropped, as World does step by step.
+        """
+        boards_count, rows = boards.shape
+        # full rows below the board block the figure like its bottom does
+        padded = np.concatenate(
+            [boards, np.full((boards_count, MAX_FIGURE_HEIGHT), self._full_row, dtype=np.int64)], axis=1
+        )
+        # free[k, o, x, y]: orientation o fits into board k with its top left corner at (x, y)
+        free = np.ones((boards_count,) + placements.masks.shape[:2] + (rows + 1,), dtype=bool)
+        for row_index in range(MAX_FIGURE_HEIGHT):
+            free &= (
+                padded[:, np.newaxis, np.newaxis, row_index: row_index + rows + 1]
+                & placements.masks[np.newaxis, :, :, np.newaxis, row_index]
+            ) == 0
+
+        spawn_x, spawn_y = World.new_figure_coordinates(self.columns)
+        free_at_spawn_row = free[:, :, :, spawn_y] & placements.fits
+        leftmost_x = self._farthest_reachable_x(free_at_spawn_row, range(spawn_x - 1, -1, -1), spawn_x)
+        rightmost_x = self._farthest_reachable_x(free_at_spawn_row, range(spawn_x + 1, self.columns), spawn_x)
+        orientation_indices = placements.orientation_indices
+        xs = np.clip(placements.xs, leftmost_x[:, orientation_indices], rightmost_x[:, orientation_indices])
+
+        free_below = free[np.arange(boards_count)[:, np.newaxis], orientation_indices, xs, spawn_y + 1:]
+        landing_ys = spawn_y + np.argmax(~free_below, axis=2)
+
+        placed = np.repeat(padded[:, np.newaxis, :], len(placements), axis=1)
+        figure_rows = landing_ys[:, :, np.newaxis] + np.arange(MAX_FIGURE_HEIGHT)
+        np.put_along_axis(
+            placed,
+            figure_rows,
+            np.take_along_axis(placed, figure_rows, axis=2) | placements.masks[orientation_indices, xs],
+            axis=2,
+        )
+        return self.remove_full_lines(placed[:, :, :rows])
+
+    @staticmethod
+    def _farthest_reachable_x(free_at_spawn_row: np.ndarray, xs: range, spawn_x: int) -> np.ndarray:
+        farthest_x = np.full(free_at_spawn_row.shape[:2], spawn_x)
+        reachable = np.ones(free_at_spawn_row.shape[:2], dtype=bool)
+        for x in xs:
+            reachable &= free_at_spawn_row[:, :, x]
+            farthest_x[reachable] = x
+        return farthest_x
+
+    def remove_full_lines(self, boards: np.ndarray) -> np.ndarray:
+        """
+        Removes the full rows of boards of any shape (..., rows), the rows above them fall down.
+        """
+        full_rows = boards == self._full_row
+        with_full_rows = full_rows.any(axis=-1)
+        if not with_full_rows.any():
+            return boards
+        full_rows = full_rows[with_full_rows]
+        # full rows go first and are cleared, the rest keep their order
+        order = np.argsort(~full_rows, axis=-1, kind='stable')
+        remaining = np.take_along_axis(boards[with_full_rows], order, axis=-1)
+        remaining[np.arange(boards.shape[-1]) < full_rows.sum(axis=-1, keepdims=True)] = 0
+        boards[with_full_rows] = remaining
+        return boards
+
+    def grids(self, boards: np.ndarray) -> np.ndarray:
+        """
+        Boards of shape (n, rows, columns) with ones for the filled cells, as features expect them.
+        """
+        return ((boards[:, :, np.newaxis] >> np.arange(self.columns)) & 1).astype(np.uint8)
+
+    def advance(self, games: np.ndarray, placements: np.ndarray, boards: np.ndarray) -> None:
+        """
+        Plays the placements, given by their indices in FigurePlacements, that result in the boards.
+        Like MoveToPosition.unroll, a placement takes the rotations, a move per column and the drop.
+        Every rotation happens at the spawn position, and a game is finished as soon as the figure
+        overlaps the filled cells there, including when the new figure appears.
+        """
+        spawn_x, spawn_y = World.new_figure_coordinates(self.columns)
+        spawn_rows = self.boards[games, spawn_y: spawn_y + MAX_FIGURE_HEIGHT]
+        figures = self.figures[games]
+        actions = np.empty(len(games), dtype=int)
+        rotated_into_cells = np.zeros(len(games), dtype=bool)
+        for figure_index in np.unique(figures):
+            indices = np.flatnonzero(figures == figure_index)
+            figure_placements = self.placements(figure_index)
+            rotations = figure_placements.orientation_indices[placements[indices]]
+            # overlaps[k, r]: the r-th rotation of the placement turns the figure over filled cells
+            rotation_counts = np.arange(len(figure_placements.spawn_masks))
+            overlaps = (
+                (spawn_rows[indices, np.newaxis, :] & figure_placements.spawn_masks[np.newaxis, :, :]).any(axis=2)
+                & (rotation_counts > 0) & (rotation_counts <= rotations[:, np.newaxis])
+            )
+            rotated_into_cells[indices] = overlaps.any(axis=1)
+            actions[indices] = np.where(
+                rotated_into_cells[indices],
+                overlaps.argmax(axis=1),
+                rotations + np.abs(figure_placements.xs[placements[indices]] - spawn_x) + 1,
+            )
+        self.actions[games] += actions
+        self.finished[games[rotated_into_cells]] = True
+
+        placed = ~rotated_into_cells
+        games = games[placed]
+        self.boards[games] = boards[placed]
+        self.figures[games] = self.next_figures[games]
+        if self.figure_sequences is not None:
+            self.next_figures[games] = self.figure_sequences[
+                games, (self.moves[games] + 2) % self.figure_sequences.shape[1]
+            ]
+        else:
+            self.next_figures[games] = self.figure_factory.next_indices(len(games))
+        self.moves[games] += 1
+
+        spawn_masks = np.stack([
+            self.placements(figure_index).spawn_masks[0] for figure_index in range(len(self.figure_factory.figures))
+        ])
+        spawn_rows = self.boards[games, spawn_y: spawn_y + MAX_FIGURE_HEIGHT]
+        self.finished[games] = (spawn_rows & spawn_masks[self.figures[games]]).any(axis=1)
+
+
+def first_max_indices(values: np.ndarray, parents: np.ndarray) -> np.ndarray:
+    """
+    Index of the first highest value of every parent, the values being ordered by parent.
+    """
+    starts = np.flatnonzero(np.r_[True, parents[1:] != parents[:-1]])
+    maxima = np.maximum.reduceat(values, starts)
+    candidates = np.flatnonzero(values == np.repeat(maxima, np.diff(np.r_[starts, len(values)])))
+    candidate_parents = parents[candidates]
+    return candidates[np.r_[True, candidate_parents[1:] != candidate_parents[:-1]]]
+
+
+class BatchPlanningAgent:
+    """
+    Chooses the placement with highest utility in every game of a BatchWorld,
+    like ReflexiveHierarchicalAgent with depth=1 or PlanningTwoMovesHierarchicalAgent with depth=2.
+    At depth 2 at most max_boards boards are evaluated at once.
+    """
+    def __init__(self, utility: BatchUtility, depth: int = 2, max_boards: int = 2 ** 16):
+        self.utility = utility
+        self.depth = depth
+        self.max_boards = max_boards
+
+    def choose_placements(self, batch_world: BatchWorld, games: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        The indices of the chosen placements in FigurePlacements and the resulting boards.
+        """
+        children, parents = batch_world.expand(batch_world.boards[games], batch_world.figures[games])
+        if self.depth == 1:
+            values = self.utility(batch_world.grids(children))
+        else:
+            values = self._best_next_values(batch_world, children, batch_world.next_figures[games][parents])
+        chosen = first_max_indices(values, parents)
+        return chosen - np.searchsorted(parents, parents[chosen]), children[chosen]
+
+    def _best_next_values(self, batch_world: BatchWorld, boards: np.ndarray, figures: np.ndarray) -> np.ndarray:
+        """
+        The highest utility after placing the figure of every board.
+        """
+        values = np.empty(len(boards))
+        max_placements = max(len(batch_world.placements(figure_index)) for figure_index in np.unique(figures))
+        step = max(1, self.max_boards // max_placements)
+        for start in range(0, len(boards), step):
+            children, parents = batch_world.expand(boards[start: start + step], figures[start: start + step])
+            children_values = self.utility(batch_world.grids(children))
+            starts = np.flatnonzero(np.r_[True, parents[1:] != parents[:-1]])
+            values[start: start + step] = np.maximum.reduceat(children_values, starts)
+        return values
@@ -0,0 +1,223 @@
+"""
+Timing the hot paths and the decisions of the agents on canned mid-game boards.
+
+    python benchmarks.py run --output results.json [--full]
+    python benchmarks.py compare baseline.json results.json [--threshold 0.2]
+
+The boards come from seeded games, so every run measures the same work.
+compare exits with status 1 if a benchmark got slower than the baseline by more than the threshold.
+"""
+import argparse
+import json
+import platform
+import statistics
+import sys
+import time
+from typing import Any, Callable, Dict, List, Tuple
+
+import numpy as np
+
+from agent import (
+    ReflexiveHierarchicalAgent, PlanningTwoMovesHierarchicalAgent, ProbabilisticPlanningHierarchicalAgent,
+    LimitedProbabilisticPlanningHierarchicalAgent, AnytimeExpectimaxAgent, TetrisStateTree, TetrisWorldNode,
+    possible_actions
+)
+from features import FringeSmoothness, HoleCount, EmptyRowsCount, AverageHeight
+from state_tree import SimpleEvaluationStrategy
+from utility import Utility
+from world import Config, World, Board, BitBoard, SequenceFigureFactory
+
+SEED = 2024
+# figures placed before the board is taken, one game per snapshot
+SNAPSHOT_MOVES = (30, 80, 150)
+WEIGHTS = [3.2375932, 14.10950807, 22.32253916, 30.96122022]
+
+
+def production_utility() -> Utility:
+    return Utility([FringeSmoothness(), HoleCount(), EmptyRowsCount(), AverageHeight()], WEIGHTS)
+
+
+def canned_worlds(board_class=Board) -> List[World]:
+    worlds = []
+    for game_index, moves in enumerate(SNAPSHOT_MOVES):
+        world = World.from_config(Config(BOARD_CLASS=board_class), SequenceFigureFactory.from_seed(SEED + game_index))
+        agent = ReflexiveHierarchicalAgent(production_utility())
+        while world.figure_factory.position - 2 < moves and not world.is_in_terminal_state():
+            agent.choose_action(world).apply(world)
+        worlds.append(world)
+    return worlds
+
+
+def measure(run: Callable[[Any], Any], make_inputs: Callable[[], List], repeats: int) -> Dict[str, float]:
+    """
+    Seconds per call of run over fresh inputs, the first pass being a warm-up.
+    """
+    seconds_per_call = []
+    for repeat_index in range(repeats + 1):
+        inputs = make_inputs()
+        start = time.perf_counter()
+        for item in inputs:
+            run(item)
+        elapsed = time.perf_counter() - start
+        if repeat_index:
+            seconds_per_call.append(elapsed / len(inputs))
+    return {
+        "min": min(seconds_per_call),
+        "median": statistics.median(seconds_per_call),
+        "calls": len(inputs),
+        "repeats": repeats,
+    }
+
+
+def placements(worlds: List[World]) -> List[Tuple[World, Any, int, int]]:
+    """
+    (world, figure, x, y) for every placement of the current figure, y being the landing row.
+    """
+    return [
+        (world,) + world.deepcopy()._drop_position(action.figure, action.x)
+        for world in worlds
+        for action in possible_actions(world)
+    ]
+
+
+def micro_benchmarks(board_class, repeats: int) -> Dict[str, Dict[str, float]]:
+    worlds = canned_worlds(board_class)
+    fixes = placements(worlds)
+    leaf_worlds = [action.apply_to_copy(world) for world in worlds for action in possible_actions(world)]
+
+    def fixed_boards():
+        boards = [world.board.deepcopy() for world, _, _, _ in fixes]
+        for board, (_, figure, x, y) in zip(boards, fixes):
+            board.fix_figure(figure, x, y)
+        return boards
+
+    name = board_class.__name__
+    results = {
+        f"{name}.fix_figure": measure(
+            lambda e: e[0].fix_figure(e[1], e[2], e[3]),
+            lambda: [(world.board.deepcopy(), figure, x, y) for world, figure, x, y in fixes],
+            repeats,
+        ),
+        f"{name}.intersects": measure(
+            lambda e: e[0].board.intersects(e[1], e[2], e[3]), lambda: fixes, repeats
+        ),
+        f"{name}.remove_full_lines": measure(lambda board: board.remove_full_lines(), fixed_boards, repeats),
+    }
+    utility = production_utility()
+    for feature in utility.features:
+        results[f"{type(feature).__name__}.value[{name}]"] = measure(feature.value, lambda: leaf_worlds, repeats)
+    results[f"Utility[{name}]"] = measure(utility, lambda: leaf_worlds, repeats)
+
+    def state_trees():
+        # expanding a node releases its world, so every expansion gets a tree of its own
+        return [
+            TetrisStateTree(TetrisWorldNode(world.deepcopy()), SimpleEvaluationStrategy(utility))
+            for world in worlds for _ in range(10)
+        ]
+
+    results[f"TetrisStateTree.expand_node[{name}]"] = measure(
+        lambda tree: list(tree.expand_node(tree.root_node)), state_trees, repeats
+    )
+    return results
+
+
+def decision_benchmarks(repeats: int, full: bool) -> Dict[str, Dict[str, float]]:
+    """
+    Time of a decision of a new agent, the agents using no process pools.
+    """
+    worlds = canned_worlds()
+    agent_factories = [
+        lambda utility: ReflexiveHierarchicalAgent(utility),
+        lambda utility: PlanningTwoMovesHierarchicalAgent(utility),
+        lambda utility: LimitedProbabilisticPlanningHierarchicalAgent(utility, processes=0),
+        lambda utility: AnytimeExpectimaxAgent(utility),
+    ]
+    if full:
+        agent_factories.append(lambda utility: ProbabilisticPlanningHierarchicalAgent(utility, processes=0))
+
+    results = {}
+    for agent_factory in agent_factories:
+        name = type(agent_factory(production_utility())).__name__
+        results[f"{name}.decision"] = measure(
+            lambda e: e[0].choose_action(e[1]),
+            lambda: [(agent_factory(production_utility()), world.deepcopy()) for world in worlds],
+            repeats,
+        )
+    return results
+
+
+def run_benchmarks(repeats: int = 5, decision_repeats: int = 2, full: bool = False) -> Dict[str, Any]:
+    np.random.seed(SEED)
+    results = {}
+    for board_class in (Board, BitBoard):
+        results.update(micro_benchmarks(board_class, repeats))
+    results.update(decision_benchmarks(decision_repeats, full))
+    return {
+        "meta": {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "machine": platform.machine(),
+            "seed": SEED,
+        },
+        "results": results,
+    }
+
+
+def compare(baseline: Dict[str, Any], current: Dict[str, Any], threshold: float = 0.2) -> List[str]:
+    """
+    Prints the ratio of the current to the baseline time of every benchmark,
+    returns the names of the ones slower by more than the threshold.
+    """
+    regressions = []
+    for name, result in current["results"].items():
+        if name not in baseline["results"]:
+            print(f"{name:55} {'':>12} {result['min'] * 1e6:10.1f}us  new")
+            continue
+        baseline_time = baseline["results"][name]["min"]
+        ratio = result["min"] / baseline_time
+        regressed = ratio > 1 + threshold
+        if regressed:
+            regressions.append(name)
+        print(
+            f"{name:55} {baseline_time * 1e6:10.1f}us {result['min'] * 1e6:10.1f}us  x{ratio:.2f}"
+            + ("  REGRESSION" if regressed else "")
+        )
+    for name in baseline["results"]:
+        if name not in current["results"]:
+            print(f"{name:55} missing")
+    return regressions
+
+
+def main(argv: List[str]) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+    run_parser = commands.add_parser("run")
+    run_parser.add_argument("--output", default="benchmarks.json")
+    run_parser.add_argument("--repeats", type=int, default=5)
+    run_parser.add_argument("--full", action="store_true", help="include ProbabilisticPlanningHierarchicalAgent")
+    compare_parser = commands.add_parser("compare")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("current")
+    compare_parser.add_argument("--threshold", type=float, default=0.2)
+    args = parser.parse_args(argv)
+
+    if args.command == "run":
+        report = run_benchmarks(repeats=args.repeats, full=args.full)
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
+        for name, result in report["results"].items():
+            print(f"{name:55} {result['min'] * 1e6:10.1f}us")
+        return 0
+
+    with open(args.baseline) as file:
+        baseline = json.load(file)
+    with open(args.current) as file:
+        current = json.load(file)
+    regressions = compare(baseline, current, args.threshold)
+    print(f"{len(regressions)} regressions" if regressions else "No regressions")
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,76 @@
+"""
+Checkpoints of games, so that long simulations survive crashes and preemption.
+"""
+import os
+import pickle
+import time
+from dataclasses import dataclass
+from typing import Any, Optional
+
+import numpy as np
+
+from agent import IAgent
+from world import World
+
+
+@dataclass
+class GameCheckpoint:
+    """
+    The world before the action iterations_count, the plan state of the agent and the global numpy random state,
+    which the figures and some agents draw from. The caches of the agents are left out,
+    they only change how fast the agent decides.
+    result is the number of actions once the game is over.
+    """
+    world: World
+    plan_state: Any
+    iterations_count: int
+    random_state: Any
+    result: Optional[int] = None
+
+    @classmethod
+    def of(cls, world: World, agent: IAgent, iterations_count: int, result: Optional[int] = None) -> 'GameCheckpoint':
+        return cls(world, agent.plan_state(), iterations_count, np.random.get_state(), result)
+
+    def save(self, path: str) -> None:
+        """
+        Written next to the path and renamed, so the file at the path is always a complete checkpoint.
+        """
+        temporary_path = f"{path}.tmp"
+        with open(temporary_path, "wb") as file:
+            pickle.dump(self, file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temporary_path, path)
+
+    @staticmethod
+    def load(path: str) -> Optional['GameCheckpoint']:
+        if not os.path.exists(path):
+            return None
+        with open(path, "rb") as file:
+            return pickle.load(file)
+
+    def restore(self, agent: IAgent) -> World:
+        np.random.set_state(self.random_state)
+        agent.restore_plan_state(self.plan_state)
+        return self.world
+
+
+class Checkpointer:
+    """
+    Saves checkpoints of a game at most every interval seconds, and not more often than needed
+    to keep the time spent on them under max_overhead of the time of the game.
+    """
+    def __init__(self, path: str, interval: float = 60., max_overhead: float = 0.01):
+        self.path = path
+        self.interval = interval
+        self.max_overhead = max_overhead
+        self._next_time = time.perf_counter() + interval
+
+    def maybe_save(self, world: World, agent: IAgent, iterations_count: int) -> None:
+        now = time.perf_counter()
+        if now < self._next_time:
+            return
+        GameCheckpoint.of(world, agent, iterations_count).save(self.path)
+        save_time = time.perf_counter() - now
+        self._next_time = now + max(self.interval, save_time / self.max_overhead)
+
+    def finish(self, world: World, agent: IAgent, iterations_count: int) -> None:
+        GameCheckpoint.of(world, agent, iterations_count, result=iterations_count).save(self.path)
@@ -1,14 +1,31 @@
-from typing import List
+from typing import List, Iterable, Dict, Type
 
 import numpy as np
 
-from world import World
+from kernels import kernels
+from world import World, BitBoard
 
 
 class Feature:
     def value(self, world: World) -> float:
         raise NotImplementedError
 
+    def batch_value(self, boards: np.ndarray) -> np.ndarray:
+        """
+        Values for a stack of boards of shape (N, rows, columns), one per board.
+        """
+        raise NotImplementedError
+
+
+def batch_empty_rows_count(boards: np.ndarray) -> np.ndarray:
+    non_empty_rows = boards.any(axis=2)
+    return np.where(non_empty_rows.any(axis=1), non_empty_rows.argmax(axis=1), boards.shape[1])
+
+
+def batch_fringe(boards: np.ndarray) -> np.ndarray:
+    filled = boards != 0
+    return np.where(filled.any(axis=1), filled.argmax(axis=1), boards.shape[1])
+
 
 def get_empty_rows_count(world: World):
     count = 0
@@ -22,9 +39,20 @@ def get_empty_rows_count(world: World):
 
 class EmptyRowsCount(Feature):
     def value(self, world: World) -> float:
-        empty_rows_count = get_empty_rows_count(world)
+        return self.from_count(get_empty_rows_count(world), world.board.height())
+
+    def batch_value(self, boards: np.ndarray) -> np.ndarray:
+        empty_rows_count = batch_empty_rows_count(boards)
+        threshold = boards.shape[1] / 3
+        return np.where(
+            empty_rows_count <= threshold,
+            empty_rows_count ** 2,
+            threshold ** 2 + (empty_rows_count - threshold),
+        ).astype(float)
 
-        threshold = world.board.height() / 3
+    @staticmethod
+    def from_count(empty_rows_count: int, board_height: int) -> float:
+        threshold = board_height / 3
         if empty_rows_count <= threshold:
             return empty_rows_count ** 2
         else:
@@ -33,20 +61,33 @@ class EmptyRowsCount(Feature):
 
 class HoleCount(Feature):
     def value(self, world: World) -> float:
-        hole_count = 0
-        filled_squares_above = np.zeros(world.board.width(), dtype=bool)
-        for row in world.board.map_fragment:
-            holes = np.logical_and(filled_squares_above, row == 0)
-            hole_count += np.count_nonzero(holes)
-            filled_squares_above = np.logical_or(filled_squares_above, row == 1)
-
+        hole_count = kernels.hole_count(world.board.map_fragment)
         filled_rows_count = world.board.height() - get_empty_rows_count(world)
+        return self.from_counts(hole_count, filled_rows_count)
+
+    def batch_value(self, boards: np.ndarray) -> np.ndarray:
+        hole_count = np.count_nonzero(
+            np.logical_and(np.logical_or.accumulate(boards == 1, axis=1), boards == 0), axis=(1, 2)
+        )
+        filled_rows_count = boards.shape[1] - batch_empty_rows_count(boards)
+        return filled_rows_count / (hole_count + 1)
+
+    @staticmethod
+    def from_counts(hole_count: int, filled_rows_count: int) -> float:
         return filled_rows_count / (hole_count + 1)
 
 
 class FringeSmoothness(Feature):
     def value(self, world: World) -> float:
-        fringe = self._fringe(world)
+        return self.from_fringe(self._fringe(world))
+
+    def batch_value(self, boards: np.ndarray) -> np.ndarray:
+        fringe = batch_fringe(boards)
+        discrepancies = np.count_nonzero(fringe[:, 1:] != fringe[:, :-1], axis=1)
+        return 1 / (discrepancies + 1)
+
+    @staticmethod
+    def from_fringe(fringe: List[int]) -> float:
         discrepancies = 0
         for i in range(len(fringe) - 1):
             discrepancies += 1 if fringe[i + 1] != fringe[i] else 0
@@ -54,23 +95,33 @@ class FringeSmoothness(Feature):
 
     @staticmethod
     def _fringe(world: World) -> List[int]:
-        fringe = []
-        for col_index in range(world.board.width()):
-            for row_index in range(world.board.height()):
-                if world.board.map_fragment[row_index, col_index]:
-                    fringe.append(row_index)
-                    break
-            else:
-                fringe.append(world.board.height())
-        return fringe
+        return kernels.fringe(world.board.map_fragment)
 
 
 class AverageHeight(Feature):
     def value(self, world: World) -> float:
+        return self.from_row_fill_counts(kernels.row_fill_counts(world.board.map_fragment), world.board.height())
+
+    def batch_value(self, boards: np.ndarray) -> np.ndarray:
+        board_height = boards.shape[1]
+        row_fill_counts = np.count_nonzero(boards[:, ::-1], axis=2)
+        empty_rows = row_fill_counts == 0
+        # only the rows below the lowest empty row are counted
+        counted_rows_count = np.where(empty_rows.any(axis=1), empty_rows.argmax(axis=1), board_height)
+        row_fill_counts = row_fill_counts * (np.arange(board_height) < counted_rows_count[:, np.newaxis])
+        filled_squares_count = row_fill_counts.sum(axis=1)
+        heights_sum = row_fill_counts @ np.arange(board_height)
+        return np.where(
+            filled_squares_count > 0,
+            board_height - heights_sum / np.maximum(filled_squares_count, 1),
+            0.,
+        )
+
+    @staticmethod
+    def from_row_fill_counts(row_fill_counts: List[int], board_height: int) -> float:
         heights_sum = 0
         filled_squares_count = 0
-        for row_index, row in enumerate(world.board.map_fragment[::-1]):
-            row_filled_squares_count = np.count_nonzero(row)
+        for row_index, row_filled_squares_count in enumerate(row_fill_counts[::-1]):
             if not row_filled_squares_count:
                 break
             filled_squares_count += row_filled_squares_count
@@ -78,4 +129,47 @@ class AverageHeight(Feature):
         if not filled_squares_count:
             return 0
         avg_height = heights_sum / filled_squares_count
-        return world.board.height() - avg_height
+        return board_height - avg_height
+
+
+class FusedFeatures:
+    """
+    Values of FringeSmoothness, HoleCount, EmptyRowsCount and AverageHeight from one scan of the board:
+    the fringe, the hole count and the row fill counts are computed once and shared by all four features.
+    The values are exactly the same as the ones of the separate features.
+    """
+    feature_types = (FringeSmoothness, HoleCount, EmptyRowsCount, AverageHeight)
+
+    def __init__(self, features: Iterable[Feature]):
+        self._feature_types_order = [type(feature) for feature in features]
+
+    @classmethod
+    def supports(cls, features: Iterable[Feature]) -> bool:
+        feature_types = [type(feature) for feature in features]
+        return len(feature_types) == len(cls.feature_types) and set(feature_types) == set(cls.feature_types)
+
+    def values(self, world: World) -> List[float]:
+        board = world.board
+        board_height = board.height()
+        if isinstance(board, BitBoard):
+            row_fill_counts = [bin(row).count("1") for row in board.rows]
+            hole_count = 0
+            filled_squares_above = 0
+            for row in board.rows:
+                hole_count += bin(filled_squares_above & ~row).count("1")
+                filled_squares_above |= row
+        else:
+            map_fragment = board.map_fragment
+            row_fill_counts = kernels.row_fill_counts(map_fragment)
+            hole_count = kernels.hole_count(map_fragment)
+
+        empty_rows_count = next(
+            (row_index for row_index, count in enumerate(row_fill_counts) if count), board_height
+        )
+        values: Dict[Type[Feature], float] = {
+            FringeSmoothness: FringeSmoothness.from_fringe(board.fringe()),
+            HoleCount: HoleCount.from_counts(hole_count, board_height - empty_rows_count),
+            EmptyRowsCount: EmptyRowsCount.from_count(empty_rows_count, board_height),
+            AverageHeight: AverageHeight.from_row_fill_counts(row_fill_counts, board_height),
+        }
+        return [values[feature_type] for feature_type in self._feature_types_order]
@@ -0,0 +1,271 @@
+"""
+Kernels of the per-cell scans of the boards: the fringe, the hole count, the row fill counts
+and the overlap of a figure with the board. A board is an array of shape (rows, columns),
+a cell being filled when it isn't 0.
+
+There are three backends giving the same results:
+    numpy - the reference one, vectorized
+    numba - loops compiled by numba, used by default when numba is installed, compiled when it is selected
+    python - the same loops not compiled, standing in for numba when it is missing
+The backend is selected at import time, TETRIS_KERNELS=numpy|numba|python overrides the default.
+
+    python kernels.py [--boards 2000]
+
+checks that all the available backends give the same results on random boards.
+"""
+import argparse
+import os
+import sys
+from typing import Dict, List
+
+import numpy as np
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+
+class NumpyKernels:
+    name = "numpy"
+
+    @staticmethod
+    def fringe(board: np.ndarray) -> List[int]:
+        """
+        Index of the topmost filled row for every column, the board height for empty columns.
+        """
+        filled = board != 0
+        return np.where(filled.any(axis=0), filled.argmax(axis=0), board.shape[0]).tolist()
+
+    @staticmethod
+    def hole_count(board: np.ndarray) -> int:
+        """
+        Number of the empty cells having a filled cell above them.
+        """
+        return int(np.count_nonzero(np.logical_and(np.logical_or.accumulate(board == 1, axis=0), board == 0)))
+
+    @staticmethod
+    def row_fill_counts(board: np.ndarray) -> List[int]:
+        return np.count_nonzero(board, axis=1).tolist()
+
+    @staticmethod
+    def overlaps(board: np.ndarray, figure: np.ndarray, x: int, y: int) -> bool:
+        """
+        Whether a filled cell of the figure placed at (x, y) covers a filled cell of the board.
+        The figure has to be within the board.
+        """
+        return bool(np.any(np.logical_and(board[y: y + figure.shape[0], x: x + figure.shape[1]], figure)))
+
+
+# The loops below index the cells as board[row][column], so they run both on nested lists
+# and, compiled by numba, on arrays. The results go to the preallocated out.
+
+def _fringe_loop(board, rows, columns, out):
+    for column in range(columns):
+        out[column] = rows
+        for row in range(rows):
+            if board[row][column] != 0:
+                out[column] = row
+                break
+    return out
+
+
+def _hole_count_loop(board, rows, columns):
+    hole_count = 0
+    for column in range(columns):
+        filled_above = False
+        for row in range(rows):
+            cell = board[row][column]
+            if cell == 1:
+                filled_above = True
+            elif cell == 0 and filled_above:
+                hole_count += 1
+    return hole_count
+
+
+def _row_fill_counts_loop(board, rows, columns, out):
+    for row in range(rows):
+        count = 0
+        for column in range(columns):
+            if board[row][column] != 0:
+                count += 1
+        out[row] = count
+    return out
+
+
+def _overlaps_loop(board, figure, figure_rows, figure_columns, x, y):
+    for row in range(figure_rows):
+        for column in range(figure_columns):
+            if figure[row][column] != 0 and board[y + row][x + column] != 0:
+                return True
+    return False
+
+
+class PythonKernels:
+    name = "python"
+
+    @staticmethod
+    def fringe(board: np.ndarray) -> List[int]:
+        rows, columns = board.shape
+        return _fringe_loop(board.tolist(), rows, columns, [0] * columns)
+
+    @staticmethod
+    def hole_count(board: np.ndarray) -> int:
+        rows, columns = board.shape
+        return _hole_count_loop(board.tolist(), rows, columns)
+
+    @staticmethod
+    def row_fill_counts(board: np.ndarray) -> List[int]:
+        rows, columns = board.shape
+        return _row_fill_counts_loop(board.tolist(), rows, columns, [0] * rows)
+
+    @staticmethod
+    def overlaps(board: np.ndarray, figure: np.ndarray, x: int, y: int) -> bool:
+        figure_rows, figure_columns = figure.shape
+        region = board[y: y + figure_rows, x: x + figure_columns].tolist()
+        return _overlaps_loop(region, figure.tolist(), figure_rows, figure_columns, 0, 0)
+
+
+if numba is not None:
+    _fringe_jit = numba.njit(cache=True)(_fringe_loop)
+    _hole_count_jit = numba.njit(cache=True)(_hole_count_loop)
+    _row_fill_counts_jit = numba.njit(cache=True)(_row_fill_counts_loop)
+    _overlaps_jit = numba.njit(cache=True)(_overlaps_loop)
+
+    class NumbaKernels:
+        name = "numba"
+
+        @staticmethod
+        def fringe(board: np.ndarray) -> List[int]:
+            rows, columns = board.shape
+            return _fringe_jit(board, rows, columns, np.empty(columns, dtype=np.int64)).tolist()
+
+        @staticmethod
+        def hole_count(board: np.ndarray) -> int:
+            rows, columns = board.shape
+            return _hole_count_jit(board, rows, columns)
+
+        @staticmethod
+        def row_fill_counts(board: np.ndarray) -> List[int]:
+            rows, columns = board.shape
+            return _row_fill_counts_jit(board, rows, columns, np.empty(rows, dtype=np.int64)).tolist()
+
+        @staticmethod
+        def overlaps(board: np.ndarray, figure: np.ndarray, x: int, y: int) -> bool:
+            figure_rows, figure_columns = figure.shape
+            return _overlaps_jit(board, figure, figure_rows, figure_columns, x, y)
+else:
+    NumbaKernels = None
+
+
+def available_backends() -> Dict[str, type]:
+    backends = {"numpy": NumpyKernels, "python": PythonKernels}
+    if NumbaKernels is not None:
+        backends["numba"] = NumbaKernels
+    return backends
+
+
+def select_backend(name: str = None) -> type:
+    """
+    The backend of the given name, by default numba if it is installed and numpy otherwise.
+    numba falls back to python when numba is missing.
+    """
+    if name is None:
+        name = "numba" if NumbaKernels is not None else "numpy"
+    if name == "numba" and NumbaKernels is None:
+        name = "python"
+    backends = available_backends()
+    if name not in backends:
+        raise ValueError(f"unknown kernels backend {name}, expected one of numpy, numba, python")
+    if name == "numba":
+        _warm_up(backends[name])
+    return backends[name]
+
+
+def _warm_up(backend: type) -> None:
+    """
+    Calls every kernel on the array types of the boards and the figures, so they are compiled,
+    or loaded from numba's cache, at import instead of in the first decision of an agent.
+    """
+    board = np.zeros((4, 4))
+    read_only_board = np.zeros((4, 4))
+    read_only_board.flags.writeable = False
+    figure = np.ones((1, 1), dtype=np.int64)
+    figure.flags.writeable = False
+    for map_fragment in (board, read_only_board):
+        backend.fringe(map_fragment)
+        backend.hole_count(map_fragment)
+        backend.row_fill_counts(map_fragment)
+        backend.overlaps(map_fragment, figure, 0, 0)
+
+
+kernels = select_backend(os.environ.get("TETRIS_KERNELS") or None)
+
+
+def random_boards(count: int, rows: int = 22, columns: int = 10, seed: int = 0) -> List[np.ndarray]:
+    """
+    Boards filled with a random density up to a random height, some of them empty or full.
+    """
+    rng = np.random.default_rng(seed)
+    boards = [np.zeros((rows, columns)), np.ones((rows, columns))]
+    while len(boards) < count:
+        board = (rng.random((rows, columns)) < rng.random()).astype(float)
+        board[:rng.integers(0, rows + 1)] = 0
+        boards.append(board)
+    return boards
+
+
+def check_parity(boards: List[np.ndarray], figures: List[np.ndarray]) -> List[str]:
+    """
+    Compares every available backend with the numpy one, returns the descriptions of the mismatches.
+    """
+    reference = NumpyKernels
+    mismatches = []
+    for name, backend in available_backends().items():
+        if backend is reference:
+            continue
+        for board_index, board in enumerate(boards):
+            for kernel in ("fringe", "hole_count", "row_fill_counts"):
+                expected = getattr(reference, kernel)(board)
+                actual = getattr(backend, kernel)(board)
+                if actual != expected:
+                    mismatches.append(f"{name}.{kernel} on board {board_index}: {actual} != {expected}")
+            rows, columns = board.shape
+            for figure_index, figure in enumerate(figures):
+                for y in range(rows - figure.shape[0] + 1):
+                    for x in range(columns - figure.shape[1] + 1):
+                        expected = reference.overlaps(board, figure, x, y)
+                        actual = backend.overlaps(board, figure, x, y)
+                        if actual != expected:
+                            mismatches.append(
+                                f"{name}.overlaps of figure {figure_index} at ({x}, {y}) on board {board_index}: "
+                                f"{actual} != {expected}"
+                            )
+    return mismatches
+
+
+def main(argv: List[str]) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--boards", type=int, default=2000)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    from world import tetris_figures
+    figures = [
+        orientation_figure.map_fragment for figure in tetris_figures for orientation_figure in figure.possible_orientations()
+    ]
+    boards = random_boards(args.boards, seed=args.seed)
+    # boards of other sizes, the compiled kernels must not assume the standard one
+    boards += random_boards(args.boards // 10, rows=7, columns=5, seed=args.seed + 1)
+    mismatches = check_parity(boards, figures)
+    for mismatch in mismatches[:20]:
+        print(mismatch)
+    print(
+        f"{len(mismatches)} mismatches" if mismatches
+        else f"{', '.join(available_backends())} agree on {len(boards)} boards, default backend {kernels.name}"
+    )
+    return 1 if mismatches else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
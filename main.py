@@ -3,7 +3,7 @@ Running the game with different agents
 """
 from agent import (
     ReflexiveHierarchicalAgent, PlanningTwoMovesHierarchicalAgent, ProbabilisticPlanningHierarchicalAgent,
-    LimitedProbabilisticPlanningHierarchicalAgent
+    LimitedProbabilisticPlanningHierarchicalAgent, AnytimeExpectimaxAgent
 )
 from features import FringeSmoothness, HoleCount, EmptyRowsCount, AverageHeight
 from tetris import Game
@@ -19,6 +19,10 @@ def run_game():
     )
     # game.run_agent(ProbabilisticPlanningHierarchicalAgent(utility))
     game.run_agent(LimitedProbabilisticPlanningHierarchicalAgent(utility))
+    # game.run_agent(AnytimeExpectimaxAgent(utility, time_budget=0.08))
+    # Game(Config(), headless=True).run_agent(
+    #     LimitedProbabilisticPlanningHierarchicalAgent(utility), fast_forward=100, frames_dir="frames"
+    # )
     # game.run_agent(PlanningOneMoveHierarchicalAgent(utility))
     # game.run_agent(ReflexiveHierarchicalAgent(utility))
 
@@ -0,0 +1,61 @@
+"""
+Per-decision metrics of the agents' searches
+"""
+import json
+from collections import deque
+from dataclasses import dataclass, field, asdict
+from typing import Dict, Optional
+
+EXPANSION = "expansion"
+EVALUATION = "evaluation"
+PROBABILISTIC = "probabilistic"
+
+
+@dataclass
+class DecisionMetrics:
+    """
+    What an agent did for one decision. The state trees and the evaluation strategies fill it in
+    while it is attached to them, the agent adds the rest.
+    times are the seconds spent per phase: expansion of the nodes, evaluation of the leaves
+    and the probabilistic evaluation, which includes the search over the possible figures.
+    evaluations counts the evaluated worlds per phase, cache hits included.
+    """
+    agent: str
+    wall_time: float = 0.
+    times: Dict[str, float] = field(default_factory=dict)
+    evaluations: Dict[str, int] = field(default_factory=dict)
+    nodes_expanded: Dict[int, int] = field(default_factory=dict)
+    cache_hits: int = 0
+    cache_misses: int = 0
+    pool_round_trips: int = 0
+    search_depth: Optional[int] = None
+
+    def add_time(self, phase: str, seconds: float) -> None:
+        self.times[phase] = self.times.get(phase, 0.) + seconds
+
+    def add_expansion(self, depth: int, seconds: float = 0.) -> None:
+        self.nodes_expanded[depth] = self.nodes_expanded.get(depth, 0) + 1
+        self.add_time(EXPANSION, seconds)
+
+    def add_evaluations(self, phase: str, count: int, seconds: float) -> None:
+        self.evaluations[phase] = self.evaluations.get(phase, 0) + count
+        self.add_time(phase, seconds)
+
+
+class MetricsRecorder:
+    """
+    Hook keeping the metrics of the last capacity decisions.
+    """
+    def __init__(self, capacity: Optional[int] = 4096):
+        self.decisions = deque(maxlen=capacity)
+
+    def __call__(self, metrics: DecisionMetrics) -> None:
+        self.decisions.append(metrics)
+
+    def dump(self, path: str) -> None:
+        """
+        Writes the kept metrics as JSON lines, one decision per line.
+        """
+        with open(path, "w") as file:
+            for metrics in self.decisions:
+                file.write(json.dumps(asdict(metrics)) + "\n")
@@ -0,0 +1,149 @@
+"""
+Compact binary recordings of games, and replaying them to any figure without the agent.
+
+A recording is a header followed by blocks of snapshot_interval placements. Every block starts
+with a snapshot of the board before its first placement, the cells packed into bits, and goes on
+with a 4-byte record per placement: rotation and coordinates of the fixed figure,
+and the index of the figure drawn after it. The header holds the indices of the first two figures.
+The blocks have a fixed size, so the world at any figure is found by seeking to the snapshot of its block
+and replaying at most snapshot_interval - 1 placements. A recording cut short by a crash is readable
+up to its last complete record.
+"""
+from typing import List
+
+import numpy as np
+
+from action import IAction, TetrisAction
+from world import Board, Figure, OrientationTable, SequenceFigureFactory, StoredPieces, World, tetris_figures
+
+MAGIC = b"TTRC"
+VERSION = 1
+HEADER = np.dtype([
+    ("magic", "S4"), ("version", "<u2"), ("rows", "<u2"), ("columns", "<u2"), ("figures", "<u2"),
+    ("snapshot_interval", "<u4"), ("first_pieces", "u1", (2,)),
+])
+RECORD = np.dtype([("rotation", "u1"), ("x", "u1"), ("y", "u1"), ("piece", "u1")])
+
+
+def snapshot_size(rows: int, columns: int) -> int:
+    return -(-rows * columns // 8)
+
+
+class GameRecorder:
+    """
+    Records the placements of a game played with primitive actions, see simulations.simulate_game.
+    The actions go through apply, which records the drops.
+    """
+    def __init__(self, path: str, world: World, snapshot_interval: int = 1024):
+        rows, columns = world.board.height(), world.board.width()
+        assert max(rows, columns) < 256, "coordinates are stored in a byte"
+        self.snapshot_interval = snapshot_interval
+        self.placements = 0
+        self._orientation_table = OrientationTable.of(world.figure_factory.figures)
+        self._file = open(path, "wb")
+        header = np.zeros((), dtype=HEADER)
+        header["magic"], header["version"] = MAGIC, VERSION
+        header["rows"], header["columns"] = rows, columns
+        header["figures"] = len(world.figure_factory.figures)
+        header["snapshot_interval"] = snapshot_interval
+        header["first_pieces"] = [self._piece(world.figure), self._piece(world.next_figure)]
+        self._file.write(header.tobytes())
+        self._write_snapshot(world)
+
+    def _write_snapshot(self, world: World) -> None:
+        self._file.write(np.packbits(world.board.map_fragment != 0).tobytes())
+        self._file.flush()
+
+    def _piece(self, figure: Figure) -> int:
+        return self._orientation_table.figure_index(figure.orientation)
+
+    def apply(self, action: IAction, world: World) -> None:
+        if not (isinstance(action, TetrisAction) and action.places_figure):
+            action.apply(world)
+            return
+        figure, x, y = world.figure, world.figure_x, world.drop_y()
+        action.apply(world)
+        record = np.array((figure.orientation.rotation, x, y, self._piece(world.next_figure)), dtype=RECORD)
+        self._file.write(record.tobytes())
+        self.placements += 1
+        if self.placements % self.snapshot_interval == 0:
+            self._write_snapshot(world)
+
+    def close(self) -> None:
+        self._file.close()
+
+
+class GameReplay:
+    """
+    A recording, memory-mapped. world_at(n) is the world before the n-th placement, n going up to len(self).
+    """
+    def __init__(self, path: str, figures: List[Figure] = tetris_figures, board_class=Board):
+        self.data = np.memmap(path, dtype=np.uint8, mode="r")
+        header = self.data[:HEADER.itemsize].view(HEADER)[0]
+        if header["magic"] != MAGIC or header["version"] != VERSION:
+            raise ValueError(f"{path} is not a game recording")
+        if header["figures"] != len(figures):
+            raise ValueError(f"{path} was recorded with {header['figures']} figures, not {len(figures)}")
+        self.rows, self.columns = int(header["rows"]), int(header["columns"])
+        self.snapshot_interval = int(header["snapshot_interval"])
+        self.figures = figures
+        self.board_class = board_class
+        self._orientation_table = OrientationTable.of(figures)
+        self._snapshot_size = snapshot_size(self.rows, self.columns)
+        self._block_size = self._snapshot_size + self.snapshot_interval * RECORD.itemsize
+
+        body_size = len(self.data) - HEADER.itemsize
+        full_blocks, rest = divmod(body_size, self._block_size)
+        self._snapshots = full_blocks + (rest >= self._snapshot_size)
+        self._placements = (
+            full_blocks * self.snapshot_interval + max(rest - self._snapshot_size, 0) // RECORD.itemsize
+        )
+        self.pieces = np.concatenate([header["first_pieces"], self.records(0, self._placements)["piece"]])
+
+    def __len__(self):
+        return self._placements
+
+    def records(self, start: int, stop: int) -> np.ndarray:
+        """
+        Records of the placements from start to stop, each one having rotation, x, y and piece.
+        """
+        blocks = []
+        for block in range(start // self.snapshot_interval, -(-stop // self.snapshot_interval)):
+            block_start = block * self.snapshot_interval
+            first, last = max(start, block_start), min(stop, block_start + self.snapshot_interval)
+            offset = self._block_offset(block) + self._snapshot_size + (first - block_start) * RECORD.itemsize
+            blocks.append(self.data[offset:offset + (last - first) * RECORD.itemsize].view(RECORD))
+        return np.concatenate(blocks) if blocks else np.zeros(0, dtype=RECORD)
+
+    def _block_offset(self, block: int) -> int:
+        return HEADER.itemsize + block * self._block_size
+
+    def snapshot(self, block: int):
+        offset = self._block_offset(block)
+        cells = np.unpackbits(self.data[offset:offset + self._snapshot_size], count=self.rows * self.columns)
+        map_fragment = cells.reshape(self.rows, self.columns).astype(float)
+        return self.board_class.from_map_fragment(map_fragment)
+
+    def world_at(self, placement: int) -> World:
+        """
+        The world before the given placement, rebuilt from the nearest snapshot.
+        Its figure factory hands out the recorded figures, starting them over after the last one.
+        """
+        if not 0 <= placement <= len(self):
+            raise IndexError(f"placement {placement} out of range 0..{len(self)}")
+        block = min(placement // self.snapshot_interval, self._snapshots - 1)
+        block_start = block * self.snapshot_interval
+        figure_factory = SequenceFigureFactory(self.figures, StoredPieces(self.pieces), position=block_start)
+        figure_x, figure_y = World.new_figure_coordinates(self.columns)
+        world = World(
+            self.snapshot(block), figure_factory.next(), figure_x, figure_y, figure_factory.next(), figure_factory
+        )
+        orientations = self._orientation_table.orientations
+        records = self.records(block_start, placement).tolist()
+        for piece, (rotation, x, y, _) in zip(self.pieces[block_start:].tolist(), records):
+            world.figure = Figure.from_orientation(orientations[piece][rotation])
+            world.figure_x, world.figure_y = x, y
+            world.fix_figure()
+            world.board.remove_full_lines()
+            world.switch_figure()
+        return world
@@ -3,29 +3,90 @@ Simulating the games without actual rendering.
 """
 
 from agent import ReflexiveHierarchicalAgent, IAgent, PlanningTwoMovesHierarchicalAgent, \
-    ProbabilisticPlanningHierarchicalAgent, LimitedProbabilisticPlanningHierarchicalAgent
+    ProbabilisticPlanningHierarchicalAgent, LimitedProbabilisticPlanningHierarchicalAgent, AnytimeExpectimaxAgent
+from batch_world import BatchWorld, BatchPlanningAgent
+from checkpoint import Checkpointer, GameCheckpoint
+from metrics import MetricsRecorder
+from recording import GameRecorder
 from features import FringeSmoothness, HoleCount, EmptyRowsCount, AverageHeight
-from utility import Utility
-from world import Config, World
+from utility import Utility, BatchUtility
+from world import Config, World, SequenceFigureFactory, GeneratedPieces, tetris_figures
 import time
 from multiprocessing import Pool
 import cProfile as profile
 import pstats
 import io
+import os
+from typing import List, Optional
+
 import numpy as np
 
 
-def simulate_game(world: World, agent: IAgent, max_iterations: int = 50000) -> int:
-    for iterations_count in range(max_iterations):
-        if world.is_in_terminal_state():
-            break
-        action = agent.choose_action(world)
-        action.apply(world)
+def simulate_game(
+        world: World, agent: IAgent, max_iterations: int = 50000, metrics_path: Optional[str] = None,
+        recording_path: Optional[str] = None, checkpoint_path: Optional[str] = None, checkpoint_interval: float = 60.
+) -> int:
+    """
+    With metrics_path, the metrics of the agent's decisions are written there as JSON lines, see metrics.py.
+    With recording_path, the placements are recorded there, see recording.GameReplay for replaying them.
+    With checkpoint_path, the game is saved there about every checkpoint_interval seconds and when it is over.
+    If a checkpoint is already there, the game goes on from it instead of starting with the given world,
+    or its result is returned if the game was over.
+    """
+    first_iteration = 0
+    checkpointer = None
+    if checkpoint_path is not None:
+        checkpoint = GameCheckpoint.load(checkpoint_path)
+        if checkpoint is not None:
+            if checkpoint.result is not None:
+                return checkpoint.result
+            world = checkpoint.restore(agent)
+            first_iteration = checkpoint.iterations_count
+        checkpointer = Checkpointer(checkpoint_path, checkpoint_interval)
+    recorder = None
+    if metrics_path is not None:
+        recorder = MetricsRecorder(None)
+        agent.attach_metrics(recorder)
+    game_recorder = GameRecorder(recording_path, world) if recording_path is not None else None
+    iterations_count = first_iteration
+    try:
+        for iterations_count in range(first_iteration, max_iterations):
+            if world.is_in_terminal_state():
+                break
+            if checkpointer is not None:
+                checkpointer.maybe_save(world, agent, iterations_count)
+            action = agent.choose_action(world)
+            if game_recorder is None:
+                action.apply(world)
+            else:
+                game_recorder.apply(action, world)
+    finally:
+        if game_recorder is not None:
+            game_recorder.close()
 
+    if recorder is not None:
+        agent.attach_metrics(None)
+        recorder.dump(metrics_path)
+    if checkpointer is not None:
+        checkpointer.finish(world, agent, iterations_count)
     return iterations_count
 
 
-def run_simulation(config):
+def simulate_games_lockstep(batch_world: BatchWorld, agent: BatchPlanningAgent, max_moves: int = 50000) -> List[int]:
+    """
+    Plays all the games of the batch world together, one figure per game at a time, until they are finished
+    or max_moves figures are placed. Returns the numbers of actions, same as simulate_game.
+    """
+    for _ in range(max_moves):
+        games = batch_world.active_games()
+        if not len(games):
+            break
+        batch_world.advance(games, *agent.choose_placements(batch_world, games))
+
+    return batch_world.actions.tolist()
+
+
+def run_simulation(config, checkpoint_path: Optional[str] = None):
     world = World.from_config(config)
     utility = Utility(
         [FringeSmoothness(), HoleCount(), EmptyRowsCount(), AverageHeight()],
@@ -35,7 +96,7 @@ def run_simulation(config):
     # agent = ProbabilisticPlanningHierarchicalAgent(utility)
     agent = PlanningTwoMovesHierarchicalAgent(utility)
     # agent = ReflexiveHierarchicalAgent(utility)
-    return simulate_game(world, agent)
+    return simulate_game(world, agent, checkpoint_path=checkpoint_path)
 
 
 def profile_simulation():
@@ -56,21 +117,76 @@ def profile_simulation():
     print(s.getvalue())
 
 
-def run_simulation_batch(simulations_count=10, processes=10):
+def run_simulation_batch(simulations_count=10, processes=10, checkpoint_dir: Optional[str] = None):
+    """
+    With checkpoint_dir, every game keeps its checkpoint there, and running the batch again
+    with the same checkpoint_dir resumes it: the finished games return their results
+    and the others go on from their last checkpoints.
+    """
     config = Config()
     start = time.time()
+    checkpoint_paths = [None] * simulations_count
+    if checkpoint_dir is not None:
+        os.makedirs(checkpoint_dir, exist_ok=True)
+        checkpoint_paths = [os.path.join(checkpoint_dir, f"game_{index}.pkl") for index in range(simulations_count)]
     if processes > 1:
         with Pool(processes=min(simulations_count, processes)) as pool:
-            results = pool.map(run_simulation, [config] * simulations_count)
+            results = pool.starmap(run_simulation, [(config, path) for path in checkpoint_paths])
     else:
-        results = [run_simulation(config)]
+        results = [run_simulation(config, checkpoint_paths[0])]
 
     print(f"{time.time() - start}s passed.")
     print(results)
     print(f"Average score: {sum(results) / len(results)}")
 
 
+def run_lockstep_simulation_batch(simulations_count=100, depth=2):
+    """
+    Same as run_simulation_batch with PlanningTwoMovesHierarchicalAgent (depth=2)
+    or ReflexiveHierarchicalAgent (depth=1), all the games played in lockstep in one process.
+    """
+    config = Config()
+    start = time.time()
+    batch_world = BatchWorld.from_config(config, simulations_count)
+    utility = BatchUtility(
+        [FringeSmoothness(), HoleCount(), EmptyRowsCount(), AverageHeight()],
+        [3.2375932, 14.10950807, 22.32253916, 30.96122022]
+    )
+    results = simulate_games_lockstep(batch_world, BatchPlanningAgent(utility, depth=depth))
+
+    print(f"{time.time() - start}s passed.")
+    print(results)
+    print(f"Average score: {sum(results) / len(results)}")
+
+
+def check_long_search_keeps_pieces(decisions: int = 5):
+    """
+    Regression check: the searches on copies of a world with a small piece buffer place many more figures
+    than the buffer holds, and the world still gets the figures of its sequence.
+    """
+    pieces = GeneratedPieces(len(tetris_figures), seed=1, batch_size=256, capacity=512)
+    world = World.from_config(Config(), SequenceFigureFactory(tetris_figures, pieces))
+    utility = Utility(
+        [FringeSmoothness(), HoleCount(), EmptyRowsCount(), AverageHeight()],
+        [3.2375932, 14.10950807, 22.32253916, 30.96122022]
+    )
+    agent = AnytimeExpectimaxAgent(utility, time_budget=0.5, max_depth=3, transposition_table_capacity=0)
+    expected_pieces = pieces.head(decisions + 2).tolist()
+    for _ in range(decisions):
+        action = agent.choose_action(world)
+        action.apply(world)
+        while not action.places_figure:
+            action = agent.choose_action(world)
+            action.apply(world)
+    figures = [tetris_figures[index] for index in expected_pieces]
+    assert world.figure == figures[decisions] and world.next_figure == figures[decisions + 1]
+    print("The searches left the figures of the world as they were")
+
+
 if __name__ == '__main__':
+    # check_long_search_keeps_pieces()
     # run_simulation_batch()
+    # run_simulation_batch(checkpoint_dir="checkpoints")  # run again to resume
+    # run_lockstep_simulation_batch()
     # profile_simulation()
     run_simulation_batch(simulations_count=1, processes=1)
@@ -1,17 +1,44 @@
 """
 Considering future states and evaluating them.
 """
-from multiprocessing import Pool
+import time
+import weakref
+from collections import OrderedDict, deque
+from multiprocessing import Pool, resource_tracker
+from multiprocessing.shared_memory import SharedMemory
 from queue import Queue
-from typing import List, Callable, Optional, Iterator, Tuple, Iterable
+from typing import List, Callable, Optional, Iterator, Tuple, Iterable, Hashable, Any, Dict
+
+import numpy as np
+
+from metrics import DecisionMetrics, EVALUATION
+from world import World, Board, Figure, FigureFactory, OrientationTable
 
 
 class Node:
-    def __init__(self, path: Optional[List] = None):
-        self.path = path or []
+    """
+    A node keeps its parent and the action leading to it from the parent instead of the whole path,
+    which is rebuilt on demand.
+    """
+    __slots__ = ("parent", "action", "_depth")
+
+    def __init__(self, parent: Optional['Node'] = None, action: Any = None):
+        self.parent = parent
+        self.action = action
+        self._depth = 0 if parent is None else parent._depth + 1
 
     def depth(self):
-        return len(self.path)
+        return self._depth
+
+    @property
+    def path(self) -> List:
+        actions = []
+        node = self
+        while node.parent is not None:
+            actions.append(node.action)
+            node = node.parent
+        actions.reverse()
+        return actions
 
 
 class IFringe:
@@ -42,6 +69,26 @@ class FringeQueue(IFringe):
         self.elements = Queue()
 
 
+class FringeDeque(IFringe):
+    """
+    First in, first out, like FringeQueue, without its locking.
+    """
+    def __init__(self):
+        self.elements = deque()
+
+    def put(self, node: Node):
+        self.elements.append(node)
+
+    def get(self) -> Node:
+        return self.elements.popleft()
+
+    def empty(self) -> bool:
+        return not self.elements
+
+    def clear(self):
+        self.elements = deque()
+
+
 class FringeListQueue(IFringe):
     def __init__(self):
         self.elements = []
@@ -59,22 +106,115 @@ class FringeListQueue(IFringe):
         self.elements = []
 
 
+class TranspositionTable:
+    """
+    Bounded cache of state values, evicting the least recently used entries.
+    Counts hits and misses of get.
+    """
+    def __init__(self, capacity: int = 2 ** 16):
+        self.capacity = capacity
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        value = self.entries.get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.entries.move_to_end(key)
+        return value
+
+    def put(self, key: Hashable, value: Any) -> None:
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __repr__(self):
+        return f"TranspositionTable(size={len(self)}/{self.capacity}, hits={self.hits}, misses={self.misses})"
+
+
 class EvaluationStrategy:
-    def __init__(self, utility: Callable[..., float]):
+    """
+    With a transposition table, the values are cached by the zobrist hash of the board,
+    so the utility must depend on the board only.
+    While metrics are attached, the evaluated worlds and the time spent on them are added to them under metrics_phase.
+    """
+    metrics: Optional[DecisionMetrics] = None
+    metrics_phase: str = EVALUATION
+
+    def __init__(self, utility: Callable[..., float], transposition_table: Optional[TranspositionTable] = None):
         self.utility = utility
+        self.transposition_table = transposition_table
 
     def node_values(self, nodes: Iterable[Node]) -> Iterable[Tuple[Node, float]]:
         raise NotImplementedError
 
+    def value(self, world) -> float:
+        if self.metrics is None:
+            return self._value(world)
+        start = time.perf_counter()
+        value = self._value(world)
+        self.metrics.add_evaluations(self.metrics_phase, 1, time.perf_counter() - start)
+        return value
+
+    def _value(self, world) -> float:
+        if self.transposition_table is None:
+            return self.utility(world)
+        key = world.board.zobrist_hash()
+        value = self.transposition_table.get(key)
+        if value is None:
+            value = self.utility(world)
+            self.transposition_table.put(key, value)
+        return value
+
+    def _values(self, worlds: List, evaluate: Callable[[List], Iterable[float]]) -> Iterable[float]:
+        """
+        Values of all the worlds, evaluating the ones missing in the transposition table with a single call.
+        """
+        if self.metrics is None:
+            return self._cached_values(worlds, evaluate)
+        start = time.perf_counter()
+        values = list(self._cached_values(worlds, evaluate))
+        self.metrics.add_evaluations(self.metrics_phase, len(worlds), time.perf_counter() - start)
+        return values
+
+    def _cached_values(self, worlds: List, evaluate: Callable[[List], Iterable[float]]) -> Iterable[float]:
+        if self.transposition_table is None:
+            return evaluate(worlds)
+        keys = [world.board.zobrist_hash() for world in worlds]
+        values = [self.transposition_table.get(key) for key in keys]
+        missing_worlds = {}
+        for key, world, value in zip(keys, worlds, values):
+            if value is None:
+                missing_worlds.setdefault(key, world)
+        if missing_worlds:
+            evaluated = dict(zip(missing_worlds, evaluate(list(missing_worlds.values()))))
+            for key, value in evaluated.items():
+                self.transposition_table.put(key, value)
+            values = [evaluated[key] if value is None else value for key, value in zip(keys, values)]
+        return values
+
 
 class SimpleEvaluationStrategy(EvaluationStrategy):
     def node_values(self, nodes: Iterable[Node]) -> Iterable[Tuple[Node, float]]:
-        return ((node, self.utility(node.world)) for node in nodes)
+        return ((node, self.value(node.world)) for node in nodes)
 
 
 class ParallelEvaluationStrategy(EvaluationStrategy):
-    def __init__(self, utility: Callable[..., float], pool: Pool = None):
-        super().__init__(utility)
+    def __init__(
+            self, utility: Callable[..., float], pool: Pool = None,
+            transposition_table: Optional[TranspositionTable] = None
+    ):
+        super().__init__(utility, transposition_table)
         self.pool = pool
 
     def __getstate__(self):
@@ -83,36 +223,245 @@ class ParallelEvaluationStrategy(EvaluationStrategy):
     def __setstate__(self, state):
         self.utility = state
         self.pool = None
+        self.transposition_table = None
 
     def node_values(self, nodes: Iterable[Node]) -> Iterable[Tuple[Node, float]]:
         nodes_list = list(nodes)
-        _map = self.pool.map if self.pool else map
-        return zip(
-            nodes_list,
-            _map(self.utility, [node.world for node in nodes_list])
+        return zip(nodes_list, self._values([node.world for node in nodes_list], self._map))
+
+    def _map(self, worlds: List) -> Iterable[float]:
+        if not self.pool:
+            return map(self.utility, worlds)
+        if self.metrics is not None:
+            self.metrics.pool_round_trips += 1
+        return self.pool.map(self.utility, worlds)
+
+
+class BatchEvaluationStrategy(EvaluationStrategy):
+    """
+    Evaluates all the nodes with a single call: their boards are stacked into an array
+    of shape (N, rows, columns) and passed to a batch utility (see utility.BatchUtility),
+    which returns the vector of values.
+    """
+    def node_values(self, nodes: Iterable[Node]) -> Iterable[Tuple[Node, float]]:
+        nodes_list = list(nodes)
+        if not nodes_list:
+            return []
+        return zip(nodes_list, self._values([node.world for node in nodes_list], self._batch_values))
+
+    def _batch_values(self, worlds: List) -> List[float]:
+        return self.utility(np.stack([world.board.map_fragment for world in worlds])).tolist()
+
+
+class SharedWorlds:
+    """
+    Worlds laid out in a shared memory block: boards, figures and figure coordinates of up to `capacity` worlds,
+    and a value per world.
+    """
+    FIELDS = 6  # figure index, rotation, next figure index, rotation, figure x, figure y
+
+    def __init__(self, shared_memory: SharedMemory, capacity: int, rows: int, columns: int):
+        self.shared_memory = shared_memory
+        self.capacity = capacity
+        self.rows = rows
+        self.columns = columns
+        buffer = shared_memory.buf
+        self.boards = np.ndarray((capacity, rows, columns), dtype=np.float64, buffer=buffer)
+        self.fields = np.ndarray(
+            (capacity, self.FIELDS), dtype=np.int64, buffer=buffer, offset=self.boards.nbytes
+        )
+        self.values = np.ndarray(
+            (capacity,), dtype=np.float64, buffer=buffer, offset=self.boards.nbytes + self.fields.nbytes
         )
 
+    @classmethod
+    def size(cls, capacity: int, rows: int, columns: int) -> int:
+        return capacity * (rows * columns + cls.FIELDS + 1) * 8
+
+    @classmethod
+    def create(cls, capacity: int, rows: int, columns: int) -> 'SharedWorlds':
+        return cls(SharedMemory(create=True, size=cls.size(capacity, rows, columns)), capacity, rows, columns)
+
+    @classmethod
+    def attach(cls, name: str, capacity: int, rows: int, columns: int) -> 'SharedWorlds':
+        try:
+            shared_memory = SharedMemory(name=name, track=False)
+        except TypeError:
+            # before Python 3.13 attaching registers the block with the resource tracker,
+            # which would destroy it when the worker exits
+            shared_memory = SharedMemory(name=name)
+            resource_tracker.unregister(shared_memory._name, "shared_memory")
+        return cls(shared_memory, capacity, rows, columns)
+
+    def write(self, index: int, world: World, orientation_table: OrientationTable) -> None:
+        self.boards[index] = world.board.map_fragment
+        self.fields[index] = (
+            orientation_table.figure_index(world.figure.orientation), world.figure.orientation.rotation,
+            orientation_table.figure_index(world.next_figure.orientation), world.next_figure.orientation.rotation,
+            world.figure_x, world.figure_y,
+        )
+
+    def read(self, index: int, figure_factory: FigureFactory, orientation_table: OrientationTable) -> World:
+        figure_index, rotation, next_figure_index, next_rotation, figure_x, figure_y = self.fields[index].tolist()
+        return World(
+            Board(self.boards[index].copy()),
+            Figure.from_orientation(orientation_table.orientations[figure_index][rotation]),
+            figure_x,
+            figure_y,
+            Figure.from_orientation(orientation_table.orientations[next_figure_index][next_rotation]),
+            figure_factory,
+        )
+
+    def close(self):
+        # views have to go before the buffer is released
+        self.boards = self.fields = self.values = None
+        self.shared_memory.close()
+
+
+_worker_state: Dict[str, Any] = {}
+
+
+def _init_shared_memory_worker(utility: Callable[..., float], figure_factory: FigureFactory):
+    _worker_state.update(
+        utility=utility,
+        figure_factory=figure_factory,
+        orientation_table=OrientationTable.of(figure_factory.figures),
+        shared_worlds=None,
+    )
+
+
+def _evaluate_shared_worlds(name: str, capacity: int, rows: int, columns: int, start: int, stop: int) -> None:
+    shared_worlds = _worker_state["shared_worlds"]
+    if shared_worlds is None or shared_worlds.shared_memory.name != name:
+        if shared_worlds is not None:
+            shared_worlds.close()
+        shared_worlds = _worker_state["shared_worlds"] = SharedWorlds.attach(name, capacity, rows, columns)
+    utility = _worker_state["utility"]
+    for index in range(start, stop):
+        world = shared_worlds.read(index, _worker_state["figure_factory"], _worker_state["orientation_table"])
+        value = utility(world)
+        shared_worlds.values[index] = value[0] if isinstance(value, tuple) else value
+
+
+class SharedMemoryEvaluationStrategy(EvaluationStrategy):
+    """
+    Evaluates worlds in long-lived worker processes that hold the utility from the start.
+    The worlds are written into a shared memory block, the workers only receive index ranges
+    and write the values back into the block, so nothing but the ranges is pickled per call.
+    Values are floats: for utilities returning tuples, the first element is taken.
+    The workers are started on the first call with the figure factory of the first world.
+    """
+    def __init__(
+            self, utility: Callable[..., float], processes: int,
+            transposition_table: Optional[TranspositionTable] = None, chunks_per_process: int = 4
+    ):
+        super().__init__(utility, transposition_table)
+        self.processes = processes
+        self.chunks_per_process = chunks_per_process
+        self._resources = {"pool": None, "shared_worlds": None}
+        self._orientation_table = None
+        weakref.finalize(self, self._release, self._resources)
+
+    def node_values(self, nodes: Iterable[Node]) -> Iterable[Tuple[Node, float]]:
+        nodes_list = list(nodes)
+        if not nodes_list:
+            return []
+        return zip(nodes_list, self._values([node.world for node in nodes_list], self._evaluate))
+
+    def _evaluate(self, worlds: List[World]) -> List[float]:
+        if self._resources["pool"] is None:
+            figure_factory = worlds[0].figure_factory
+            self._orientation_table = OrientationTable.of(figure_factory.figures)
+            self._resources["pool"] = Pool(
+                self.processes, initializer=_init_shared_memory_worker, initargs=(self.utility, figure_factory)
+            )
+
+        rows, columns = worlds[0].board.height(), worlds[0].board.width()
+        shared_worlds = self._resources["shared_worlds"]
+        if (
+                shared_worlds is None or shared_worlds.capacity < len(worlds)
+                or (shared_worlds.rows, shared_worlds.columns) != (rows, columns)
+        ):
+            if shared_worlds is not None:
+                shared_worlds.close()
+                shared_worlds.shared_memory.unlink()
+            shared_worlds = self._resources["shared_worlds"] = SharedWorlds.create(
+                max(len(worlds), 2 * (shared_worlds.capacity if shared_worlds else 0)), rows, columns
+            )
+
+        for index, world in enumerate(worlds):
+            shared_worlds.write(index, world, self._orientation_table)
+        chunk_size = -(-len(worlds) // (self.processes * self.chunks_per_process))
+        if self.metrics is not None:
+            self.metrics.pool_round_trips += 1
+        self._resources["pool"].starmap(_evaluate_shared_worlds, [
+            (shared_worlds.shared_memory.name, shared_worlds.capacity, rows, columns, start,
+             min(start + chunk_size, len(worlds)))
+            for start in range(0, len(worlds), chunk_size)
+        ])
+        return shared_worlds.values[:len(worlds)].tolist()
+
+    def close(self):
+        self._release(self._resources)
+
+    @staticmethod
+    def _release(resources: Dict[str, Any]):
+        if resources["pool"] is not None:
+            resources["pool"].terminate()
+            resources["pool"] = None
+        if resources["shared_worlds"] is not None:
+            resources["shared_worlds"].close()
+            resources["shared_worlds"].shared_memory.unlink()
+            resources["shared_worlds"] = None
+
 
 class StateTree:
+    """
+    Without a fringe type the tree is traversed depth-first, so only the children of the nodes
+    on the current path are held, and the leaves come in the same order as breadth-first.
+    """
     def __init__(
             self, root_node: Node, evaluation_strategy: EvaluationStrategy,
-            fringe_type: Callable[[], IFringe] = FringeQueue
+            fringe_type: Optional[Callable[[], IFringe]] = None
     ):
         self.root_node = root_node
         self.evaluation_strategy = evaluation_strategy
-        self.fringe = fringe_type()
+        self.fringe = fringe_type() if fringe_type is not None else None
 
     def leaves(self, depth: int) -> Iterator[Node]:
+        if self.fringe is None:
+            yield from self._depth_first_leaves(depth)
+            return
         self.fringe.put(self.root_node)
         while not self.fringe.empty():
             node = self.fringe.get()
             if node.depth() == depth:
                 yield node
             else:
-                children = self.expand_node(node)
-                for child in children:
+                for child in self.expanded(node):
                     self.fringe.put(child)
 
+    def _depth_first_leaves(self, depth: int) -> Iterator[Node]:
+        stack = [self.root_node]
+        while stack:
+            node = stack.pop()
+            if node.depth() == depth:
+                yield node
+            else:
+                stack.extend(reversed(self.expanded(node)))
+
+    def expanded(self, node: Node) -> List[Node]:
+        """
+        The children of the node, the expansion being added to the metrics of the evaluation strategy if it has them.
+        """
+        metrics = self.evaluation_strategy.metrics
+        if metrics is None:
+            return list(self.expand_node(node))
+        start = time.perf_counter()
+        children = list(self.expand_node(node))
+        metrics.add_expansion(node.depth(), time.perf_counter() - start)
+        return children
+
     def max(self, depth_limit) -> Node:
         return max(
             self.evaluation_strategy.node_values(self.leaves(depth_limit)),
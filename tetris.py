@@ -6,15 +6,20 @@ Improving the code in this file isn't worth the effort, so I won't be doing that
 """
 
 import functools
+import os
+import queue
+import threading
 import time
-from typing import Tuple, Callable, Dict
+from typing import Tuple, Callable, Dict, Optional
 
 import numpy as np
 import pygame
 import sys
 
-from world import World, Config
+from world import World, Config, SequenceFigureFactory
+from action import TetrisAction
 from agent import IAgent
+from metrics import MetricsRecorder
 
 
 class Color:
@@ -24,10 +29,101 @@ class Color:
 
 
 TIMER_EVENT = pygame.USEREVENT + 1
+EMPTY_CELL, BOARD_CELL, FIGURE_CELL = 0, 1, 2
+
+
+class AgentWorker(threading.Thread):
+    """
+    Runs the agent in a background thread, so a slow search doesn't stall rendering and event handling.
+    submit gives it the world at the spawn of a figure, and it streams the actions placing the figure
+    through a queue as soon as they are chosen. If the figures come from a SequenceFigureFactory,
+    the world at the next spawn is known, so meanwhile it plans the following figure on that world,
+    and uses that plan if the submitted world turns out to be the predicted one. With other figure factories
+    the copies of the world draw from the same random state as the game, so the worker neither predicts
+    nor places the figure on its copy, which would draw figures the game doesn't get.
+    Only the worker touches the agent while it runs.
+    """
+    def __init__(self, agent: IAgent):
+        super().__init__(daemon=True)
+        self.agent = agent
+        self._worlds = queue.Queue()
+        self._actions = queue.Queue()
+
+    def submit(self, world: World) -> None:
+        self._worlds.put(world.deepcopy())
+
+    def stop(self) -> None:
+        """
+        Stops the worker once it is done with the current search, join waits for that.
+        """
+        self._worlds.put(None)
+
+    def next_action(self, timeout: float = 0.) -> Optional[TetrisAction]:
+        """
+        The next action, or None if it is not chosen within timeout seconds. Doesn't block with no timeout.
+        """
+        try:
+            return self._actions.get(timeout=timeout) if timeout else self._actions.get_nowait()
+        except queue.Empty:
+            return None
+
+    def run(self):
+        # the world at the spawn of the next figure, the actions placing it, the world after them,
+        # and the plan state of the agent before it planned them
+        prediction = None
+        while True:
+            world = self._worlds.get()
+            if world is None:
+                return
+            speculate = isinstance(world.figure_factory, SequenceFigureFactory)
+            if prediction is not None and self._same_spawn(world, prediction[0]):
+                _, actions, world, _ = prediction
+                for action in actions:
+                    self._actions.put(action)
+            else:
+                if prediction is not None:
+                    self.agent.restore_plan_state(prediction[3])
+                self._place_figure(world, self._actions.put, apply_placement=speculate)
+            prediction = None
+            if speculate and not world.is_in_terminal_state() and self._worlds.empty():
+                plan_state = self.agent.plan_state()
+                predicted_world, actions = world.deepcopy(), []
+                self._place_figure(predicted_world, actions.append)
+                prediction = (world, actions, predicted_world, plan_state)
+
+    def _place_figure(
+            self, world: World, put: Callable[[TetrisAction], None], apply_placement: bool = True
+    ) -> None:
+        """
+        Plays the actions of the agent on the world until the figure is placed, putting every action.
+        The action placing the figure is only put without apply_placement.
+        """
+        while not world.is_in_terminal_state():
+            action = self.agent.choose_action(world)
+            put(action)
+            if action.places_figure and not apply_placement:
+                return
+            action.apply(world)
+            if action.places_figure:
+                return
+
+    @staticmethod
+    def _same_spawn(world: World, predicted_world: World) -> bool:
+        return (
+            world.figure == predicted_world.figure and world.next_figure == predicted_world.next_figure
+            and np.array_equal(world.board.map_fragment, predicted_world.board.map_fragment)
+        )
 
 
 class Game:
-    def __init__(self, config: Config):
+    """
+    Only the rows of the board that changed since the last frame are drawn, from pre-rendered surfaces.
+    With headless=True, SDL's dummy video driver is used, so the game runs without a display,
+    see run_agent for saving the frames.
+    """
+    def __init__(self, config: Config, headless: bool = False):
+        if headless:
+            os.environ["SDL_VIDEODRIVER"] = "dummy"
         cell_size, rows, cols = config.CELL_SIZE, config.ROWS, config.COLS
         self.config = config
         self.width = cell_size * (cols + 6)
@@ -48,22 +144,33 @@ class Game:
         self.default_font = pygame.font.Font(pygame.font.get_default_font(), 12)
         pygame.key.set_repeat(250, 25)
         pygame.event.set_blocked(pygame.MOUSEMOTION)
+        self.background = pygame.Surface((self.rlim, self.height))
+        self.draw_map_fragment(self.bground_grid, 0, 0, cell_size, Color.BACKGROUND, self.background)
+        self.cell_surfaces = {}
+        for cell_code, color in ((BOARD_CELL, Color.BOARD), (FIGURE_CELL, Color.FIGURE)):
+            self.cell_surfaces[cell_code] = pygame.Surface((cell_size, cell_size))
+            self.cell_surfaces[cell_code].fill(color)
+        # what is on the screen: the cell codes of the board and the next figure, None to redraw everything
+        self.rendered_cells: Optional[np.ndarray] = None
+        self.rendered_next_figure = None
 
         self.init_game()
 
     def init_game(self):
         self.world = World.from_config(self.config)
+        self.rendered_cells = None
         self.key_actions = self.create_key_actions()
         pygame.time.set_timer(TIMER_EVENT, 100)
 
     def draw_map_fragment(
-            self, matrix: np.ndarray, offset_x: int, offset_y: int, cell_size: int, color: Tuple[int, int, int]
+            self, matrix: np.ndarray, offset_x: int, offset_y: int, cell_size: int, color: Tuple[int, int, int],
+            surface: Optional[pygame.Surface] = None
     ):
         for y, row in enumerate(matrix):
             for x, val in enumerate(row):
                 if val:
                     pygame.draw.rect(
-                        self.screen,
+                        surface or self.screen,
                         color,
                         pygame.Rect(
                             (offset_x + x) * cell_size,
@@ -85,18 +192,49 @@ class Game:
         sys.exit()
 
     def render_game_state(self):
-        pygame.draw.line(self.screen,
-                         (255, 255, 255),
-                         (self.rlim + 1, 0),
-                         (self.rlim + 1, self.height - 1))
         cell_size, cols = self.config.CELL_SIZE, self.config.COLS
-        self.draw_map_fragment(self.bground_grid, 0, 0, cell_size, Color.BACKGROUND)
-        self.draw_map_fragment(self.world.board.map_fragment, 0, 0, cell_size, Color.BOARD)
-        self.draw_map_fragment(
-            self.world.figure.map_fragment, self.world.figure_x, self.world.figure_y, cell_size, Color.FIGURE)
-        self.draw_map_fragment(
-            self.world.next_figure.map_fragment, cols + 1, 2, cell_size, Color.FIGURE)
-        pygame.display.update()
+        cells = self.cell_codes()
+        if self.rendered_cells is None:
+            self.screen.fill((0, 0, 0))
+            pygame.draw.line(self.screen,
+                             (255, 255, 255),
+                             (self.rlim + 1, 0),
+                             (self.rlim + 1, self.height - 1))
+            dirty_rows = range(len(cells))
+            self.rendered_next_figure = None
+            dirty_rects = [self.screen.get_rect()]
+        else:
+            dirty_rows = np.flatnonzero((cells != self.rendered_cells).any(axis=1)).tolist()
+            dirty_rects = []
+
+        for y in dirty_rows:
+            row_rect = pygame.Rect(0, y * cell_size, self.rlim, cell_size)
+            self.screen.blit(self.background, row_rect, row_rect)
+            for x in np.flatnonzero(cells[y]).tolist():
+                self.screen.blit(self.cell_surfaces[cells[y, x]], (x * cell_size, y * cell_size))
+            dirty_rects.append(row_rect)
+        self.rendered_cells = cells
+
+        if self.world.next_figure != self.rendered_next_figure:
+            preview_rect = pygame.Rect((cols + 1) * cell_size, 2 * cell_size, 4 * cell_size, 4 * cell_size)
+            self.screen.fill((0, 0, 0), preview_rect)
+            self.draw_map_fragment(self.world.next_figure.map_fragment, cols + 1, 2, cell_size, Color.FIGURE)
+            self.rendered_next_figure = self.world.next_figure
+            dirty_rects.append(preview_rect)
+        pygame.display.update(dirty_rects)
+
+    def cell_codes(self) -> np.ndarray:
+        """
+        The board with the falling figure, BOARD_CELL and FIGURE_CELL marking the filled cells.
+        """
+        cells = np.where(np.asarray(self.world.board.map_fragment) != 0, BOARD_CELL, EMPTY_CELL)
+        figure = self.world.figure.map_fragment
+        figure_cells = cells[
+            self.world.figure_y:self.world.figure_y + figure.shape[0],
+            self.world.figure_x:self.world.figure_x + figure.shape[1],
+        ]
+        figure_cells[figure[:figure_cells.shape[0], :figure_cells.shape[1]] != 0] = FIGURE_CELL
+        return cells
 
     def if_not_paused(self, func: Callable) -> Callable:
         @functools.wraps(func)
@@ -131,7 +269,6 @@ class Game:
 
         clock = pygame.time.Clock()
         while True:
-            self.screen.fill((0, 0, 0))
             if self.game_over:
                 break
             if self.paused:
@@ -153,38 +290,72 @@ class Game:
                         if event.key == getattr(pygame, f"K_{key}"):
                             self.key_actions[key]()
 
-    def run_agent(self, agent: IAgent):
+    def run_agent(
+            self, agent: IAgent, metrics_path: Optional[str] = None, actions_per_second: Optional[float] = 10.,
+            fast_forward: int = 0, frames_dir: Optional[str] = None
+    ):
+        """
+        The agent runs in an AgentWorker, the game only applies the actions it streams,
+        at most actions_per_second of them, or all the ready ones every frame if it is None.
+        There is no gravity, so the game is the same as in simulations.simulate_game.
+        With fast_forward > 0, the game is rendered once per fast_forward figures, which are played
+        as fast as the agent chooses the actions.
+        With frames_dir, every rendered frame is saved there, to watch headless games.
+        With metrics_path, the metrics of the agent's decisions are written there as JSON lines when the game is over.
+        """
         self.game_over = False
         self.paused = False
+        recorder = None
+        if metrics_path is not None:
+            recorder = MetricsRecorder(None)
+            agent.attach_metrics(recorder)
+        if frames_dir is not None:
+            os.makedirs(frames_dir, exist_ok=True)
+        pygame.time.set_timer(TIMER_EVENT, 0)
+        worker = AgentWorker(agent)
+        worker.start()
+        worker.submit(self.world)
 
         clock = pygame.time.Clock()
-        while True:
-            if self.game_over:
-                break
+        next_action_time = time.perf_counter()
+        placements_count, next_rendered_placement, frames_count = 0, 0, 0
+        while not self.game_over:
+            for event in pygame.event.get():
+                if event.type == pygame.QUIT:
+                    worker.stop()
+                    self.quit()
+                elif event.type == pygame.KEYDOWN and event.key == pygame.K_p:
+                    self.toggle_pause()
 
-            self.screen.fill((0, 0, 0))
+            while not self.paused and (fast_forward or time.perf_counter() >= next_action_time):
+                action = worker.next_action(timeout=1 / self.config.MAXFPS if fast_forward else 0.)
+                if action is None:
+                    break
+                action.apply(self.world)
+                if self.world.is_in_terminal_state():
+                    self.game_over = True
+                    break
+                if action.places_figure:
+                    placements_count += 1
+                    worker.submit(self.world)
+                    if fast_forward and placements_count >= next_rendered_placement:
+                        break
+                if actions_per_second is not None and not fast_forward:
+                    next_action_time = time.perf_counter() + 1 / actions_per_second
+                    break
+
+            if fast_forward and placements_count < next_rendered_placement and not (self.game_over or self.paused):
+                continue
+            next_rendered_placement = placements_count + fast_forward
             self.render_game_state()
+            if frames_dir is not None:
+                pygame.image.save(self.screen, os.path.join(frames_dir, f"frame_{frames_count:06d}.png"))
+                frames_count += 1
+            if not fast_forward or self.paused:
+                clock.tick(self.config.MAXFPS)
 
-            clock.tick(self.config.MAXFPS)
-            for event in pygame.event.get():
-                if event.type == TIMER_EVENT:
-                    self.world.step()
-                    if self.world.is_in_terminal_state():
-                        self.game_over = True
-                        break
-                    recent_action = None
-                    while True:
-                        action = agent.choose_action(self.world)
-                        if recent_action is None or action == recent_action:
-                            action.apply(self.world)
-                            recent_action = action
-                        else:
-                            self.screen.fill((0, 0, 0))
-                            self.render_game_state()
-                            time.sleep(0.1)
-                            action.apply(self.world)
-                            break
-                    pygame.event.clear()  # don't queue multiple events during debugging
-                    time.sleep(0.1)
-                elif event.type == pygame.QUIT:
-                    self.quit()
+        worker.stop()
+        worker.join()
+        if recorder is not None:
+            agent.attach_metrics(None)
+            recorder.dump(metrics_path)
@@ -3,44 +3,84 @@ Fitting the feature weights with genetic algorithm
 """
 import time
 from multiprocessing import Pool
+from typing import List, Sequence, Tuple
 
 import numpy as np
 import pygad
 
-from agent import ReflexiveHierarchicalAgent, IAgent
+from batch_world import BatchWorld, BatchPlanningAgent
 from features import FringeSmoothness, HoleCount, EmptyRowsCount, AverageHeight
-from utility import Utility
-from world import Config, World
-
-
-def simulate_game(world: World, agent: IAgent, max_iterations: int = 10000) -> int:
-    for iterations_count in range(max_iterations):
-        if world.is_in_terminal_state():
-            break
-        action = agent.choose_action(world)
-        agent.act(world, action)
-
-    return iterations_count
+from simulations import simulate_games_lockstep
+from utility import BatchUtility
+from world import Config, FigureFactory, SequenceFigureFactory, default_figure_factory
 
 
 pool: Pool = None
+successive_halving_fitness: 'SuccessiveHalvingFitness' = None
 
 seed = 1234
 
 
-def run_simulation(index, weights):
-    config = Config()
-    np.random.seed(seed + index)
-    world = World.from_config(config)
-    utility = Utility([FringeSmoothness(), HoleCount(), EmptyRowsCount(), AverageHeight()], weights)
-    agent = ReflexiveHierarchicalAgent(utility)
-    return simulate_game(world, agent)
-
-
-def fitness_func(weights, _):
-    simulations_count = 10
-    results = pool.starmap(run_simulation, [(i, weights) for i in range(simulations_count)])
-    return sum(results) / len(results)
+def piece_sequences(
+        games_count: int, length: int, sequences_seed: int, figure_factory: FigureFactory = default_figure_factory
+) -> np.ndarray:
+    """
+    Figure indices for every game, game i getting the figures of SequenceFigureFactory.from_seed(sequences_seed + i).
+    """
+    return np.stack([
+        SequenceFigureFactory.from_seed(
+            sequences_seed + game_index, figure_factory.figures, figure_factory.random.weights
+        ).pieces.head(length)
+        for game_index in range(games_count)
+    ])
+
+
+def play_games(weights, figure_sequences: np.ndarray, max_moves: int) -> float:
+    """
+    Mean number of figures placed by ReflexiveHierarchicalAgent with the weights in the games
+    with the given figures, all the games played in lockstep.
+    """
+    batch_world = BatchWorld.from_config(Config(), len(figure_sequences), figure_sequences=figure_sequences)
+    utility = BatchUtility([FringeSmoothness(), HoleCount(), EmptyRowsCount(), AverageHeight()], weights)
+    simulate_games_lockstep(batch_world, BatchPlanningAgent(utility, depth=1), max_moves)
+    return float(batch_world.moves.mean())
+
+
+class SuccessiveHalvingFitness:
+    """
+    Fitness of a batch of candidates that play the same games (common random numbers),
+    so the differences between them don't come from the figures they got.
+    The candidates race through rungs of (games count, max figures per game):
+    after every rung only the best 1 / reduction_factor of them go on to the next one.
+    The fitness is the number of the last rung a candidate played plus its mean number of placed figures there,
+    scaled below 1, so a candidate that went further always ranks higher.
+    """
+    def __init__(
+            self, evaluation_pool: Pool, rungs: Sequence[Tuple[int, int]] = ((4, 250), (8, 1000), (10, 2500)),
+            reduction_factor: int = 3
+    ):
+        self.evaluation_pool = evaluation_pool
+        self.rungs = rungs
+        self.reduction_factor = reduction_factor
+
+    def __call__(self, candidates: np.ndarray, sequences_seed: int) -> List[float]:
+        games_count = max(rung_games_count for rung_games_count, _ in self.rungs)
+        max_moves = max(rung_max_moves for _, rung_max_moves in self.rungs)
+        figure_sequences = piece_sequences(games_count, max_moves + 2, sequences_seed)
+
+        fitness = np.zeros(len(candidates))
+        racing = np.arange(len(candidates))
+        for rung_index, (rung_games_count, rung_max_moves) in enumerate(self.rungs):
+            scores = np.array(self.evaluation_pool.starmap(play_games, [
+                (candidates[index], figure_sequences[:rung_games_count], rung_max_moves) for index in racing
+            ]))
+            fitness[racing] = rung_index + scores / (rung_max_moves + 1)
+            racing = racing[np.argsort(-scores, kind='stable')[:max(1, len(racing) // self.reduction_factor)]]
+        return fitness.tolist()
+
+
+def fitness_func(weights_batch, _):
+    return successive_halving_fitness(weights_batch, seed)
 
 
 def train():
@@ -67,11 +107,14 @@ def train():
         print(f"{time.time() - start}s passed")
         # print("Fitness    = {fitness}".format(fitness=ga_instance.best_solution()[1]))
 
-    global pool
+    global pool, successive_halving_fitness
     pool = Pool(10)
+    successive_halving_fitness = SuccessiveHalvingFitness(pool)
+    # the whole population races at once, the kept parents keep their fitness from the previous generation
     ga_instance = pygad.GA(num_generations=num_generations,
                            num_parents_mating=num_parents_mating,
                            fitness_func=fitness_func,
+                           fitness_batch_size=sol_per_pop,
                            sol_per_pop=sol_per_pop,
                            num_genes=num_genes,
                            init_range_low=init_range_low,
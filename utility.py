@@ -1,17 +1,44 @@
 from typing import Iterable, List, Tuple
 
-from features import Feature
+import numpy as np
+
+from features import Feature, FusedFeatures
 
 
 class Utility:
     def __init__(self, features: Iterable[Feature], coefficients: Iterable[float]):
-        self.features = features
+        self.features = list(features)
         self.coefficients = coefficients
+        self._fused_features = FusedFeatures(self.features) if FusedFeatures.supports(self.features) else None
 
     def __call__(self, world) -> Tuple[float, List[float], List[float]]:
-        feature_values = [feature.value(world) for feature in self.features]
+        if self._fused_features is not None:
+            feature_values = self._fused_features.values(world)
+        else:
+            feature_values = [feature.value(world) for feature in self.features]
         weighted_feature_values = [
             coefficient * feature_value
             for feature_value, coefficient in zip(feature_values, self.coefficients)
         ]
         return sum(weighted_feature_values), feature_values, weighted_feature_values
+
+
+class BatchUtility:
+    """
+    Utility of a whole stack of boards of shape (N, rows, columns) at once.
+    Every feature is computed for all the boards with Feature.batch_value,
+    the result is the vector of utility values, equal to the first element of what Utility returns.
+    """
+    def __init__(self, features: Iterable[Feature], coefficients: Iterable[float]):
+        self.features = list(features)
+        self.coefficients = list(coefficients)
+
+    @classmethod
+    def from_utility(cls, utility: Utility) -> 'BatchUtility':
+        return cls(utility.features, utility.coefficients)
+
+    def __call__(self, boards: np.ndarray) -> np.ndarray:
+        values = np.zeros(len(boards))
+        for feature, coefficient in zip(self.features, self.coefficients):
+            values = values + coefficient * feature.batch_value(boards)
+        return values
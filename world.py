@@ -2,10 +2,12 @@
 Tetris world with all rules
 """
 from dataclasses import dataclass
-from typing import List
+from typing import List, Type, Tuple, Any, Optional, Union
 
 import numpy as np
 
+from kernels import kernels
+
 
 class MapFragmentMixin:
     def __init__(self, map_fragment):
@@ -25,32 +27,118 @@ class MapFragmentMixin:
         return self._width
 
 
+def row_to_mask(row: np.ndarray) -> int:
+    mask = 0
+    for col_index, value in enumerate(row):
+        if value:
+            mask |= 1 << col_index
+    return mask
+
+
+class Orientation:
+    """
+    Immutable orientation of a figure with precomputed geometry.
+    Orientations are interned, so equal map fragments always give the same object,
+    and every orientation knows the cycle of clockwise rotations it belongs to.
+    """
+    _interned = {}
+
+    __slots__ = (
+        'map_fragment', 'height', 'width', 'row_masks', 'bottom_profile', 'top_profile',
+        'rotation', 'period', 'rotated', 'cycle',
+    )
+
+    def __init__(self, map_fragment: np.ndarray, rotation: int):
+        self.map_fragment = np.array(map_fragment)
+        self.map_fragment.flags.writeable = False
+        self.height, self.width = self.map_fragment.shape
+        self.row_masks = tuple(row_to_mask(row) for row in self.map_fragment)
+        filled_columns = [(col_index, np.flatnonzero(column)) for col_index, column in enumerate(self.map_fragment.T)]
+        # (column, lowest filled row) and (column, topmost filled row) for every non-empty column
+        self.bottom_profile = tuple((col_index, int(rows[-1])) for col_index, rows in filled_columns if len(rows))
+        self.top_profile = tuple((col_index, int(rows[0])) for col_index, rows in filled_columns if len(rows))
+        self.rotation = rotation
+        self.period = None
+        self.rotated = None
+        self.cycle = None
+
+    @staticmethod
+    def _key(map_fragment: np.ndarray):
+        return map_fragment.shape, np.asarray(map_fragment != 0, dtype=np.uint8).tobytes()
+
+    @classmethod
+    def of(cls, map_fragment: np.ndarray) -> 'Orientation':
+        """
+        The interned orientation for the map fragment.
+        The first fragment of a new figure becomes its spawn orientation with rotation 0.
+        """
+        orientation = cls._interned.get(cls._key(map_fragment))
+        if orientation is not None:
+            return orientation
+
+        orientations = []
+        fragment = np.asarray(map_fragment)
+        for rotation in range(4):
+            if cls._key(fragment) in cls._interned:
+                break
+            orientation = cls(fragment, rotation)
+            cls._interned[cls._key(fragment)] = orientation
+            orientations.append(orientation)
+            fragment = np.rot90(fragment)
+
+        for index, orientation in enumerate(orientations):
+            orientation.period = len(orientations)
+            orientation.rotated = orientations[(index + 1) % len(orientations)]
+            orientation.cycle = tuple(orientations[index:] + orientations[:index])
+        return orientations[0]
+
+    def rotations_to(self, other: 'Orientation') -> int:
+        """
+        Number of clockwise rotations that turn this orientation into the other one.
+        """
+        if other not in self.cycle:
+            raise ValueError("Orientations belong to different figures")
+        return (other.rotation - self.rotation) % self.period
+
+    def __reduce__(self):
+        return Orientation.of, (self.map_fragment,)
+
+    def __repr__(self):
+        return f"Orientation({self.map_fragment.tolist()})"
+
+
 @dataclass
 class Figure(MapFragmentMixin):
     def __init__(self, map_fragment: np.ndarray):
-        super().__init__(map_fragment)
+        self.orientation = Orientation.of(map_fragment)
+        super().__init__(self.orientation.map_fragment)
+
+    @classmethod
+    def from_orientation(cls, orientation: Orientation) -> 'Figure':
+        figure = cls.__new__(cls)
+        figure.orientation = orientation
+        MapFragmentMixin.__init__(figure, orientation.map_fragment)
+        return figure
 
     def rotate_clockwise(self) -> None:
-        self.map_fragment = np.rot90(self.map_fragment)
+        self.orientation = self.orientation.rotated
+        self.map_fragment = self.orientation.map_fragment
         self.set_height_and_width()
 
     def copy(self):
-        return Figure(self.map_fragment.copy())
+        return Figure.from_orientation(self.orientation)
 
     def possible_orientations(self):
-        unique_orientations = [self.copy()]
-        figure_copy = self.copy()
-        for _ in range(3):
-            figure_copy.rotate_clockwise()
-            if figure_copy not in unique_orientations:
-                unique_orientations.append(figure_copy.copy())
-        return unique_orientations
+        return [Figure.from_orientation(orientation) for orientation in self.orientation.cycle]
 
     def __eq__(self, other):
-        return np.array_equal(self.map_fragment, other.map_fragment)
+        return isinstance(other, Figure) and self.orientation is other.orientation
 
     def deepcopy(self):
-        return Figure(self.map_fragment.copy())
+        return Figure.from_orientation(self.orientation)
+
+    def __reduce__(self):
+        return Figure, (self.map_fragment,)
 
 
 tetris_figures = [Figure(np.asarray(e)) for e in (
@@ -76,12 +164,52 @@ tetris_figures = [Figure(np.asarray(e)) for e in (
 )]
 
 
+class OrientationTable:
+    """
+    Orientations of every figure of a piece set, spawn orientation first.
+    Built once per piece set, see OrientationTable.of.
+    """
+    _tables = {}
+
+    def __init__(self, figures: List[Figure]):
+        self.orientations: List[Tuple[Orientation, ...]] = [figure.orientation.cycle for figure in figures]
+        self._figure_indices = {
+            orientation: figure_index
+            for figure_index, orientations in enumerate(self.orientations)
+            for orientation in orientations
+        }
+
+    @classmethod
+    def of(cls, figures: List[Figure]) -> 'OrientationTable':
+        key = tuple(figure.orientation for figure in figures)
+        if key not in cls._tables:
+            cls._tables[key] = cls(figures)
+        return cls._tables[key]
+
+    def figure_index(self, orientation: Orientation) -> int:
+        return self._figure_indices[orientation]
+
+
+tetris_orientations = OrientationTable.of(tetris_figures)
+
+
 class Random:
-    def __init__(self, options_num: int):
+    """
+    Uniform unless relative weights of the options are given.
+    """
+    def __init__(self, options_num: int, weights: Optional[List[float]] = None):
         self.options_num = options_num
+        self.weights = weights
 
     def randint(self) -> int:
-        return np.random.randint(0, self.options_num)
+        if self.weights is None:
+            return np.random.randint(0, self.options_num)
+        return np.random.choice(self.options_num, p=np.asarray(self.weights) / sum(self.weights))
+
+    def randints(self, size: int) -> np.ndarray:
+        if self.weights is None:
+            return np.random.randint(0, self.options_num, size=size)
+        return np.random.choice(self.options_num, size=size, p=np.asarray(self.weights) / sum(self.weights))
 
 
 class FigureFactory:
@@ -92,6 +220,18 @@ class FigureFactory:
     def next(self) -> Figure:
         return self.figures[self.random.randint()].deepcopy()
 
+    def next_indices(self, size: int) -> np.ndarray:
+        """
+        Indices of the next figures of several independent games.
+        """
+        return self.random.randints(size)
+
+    def figure_weights(self) -> List[float]:
+        """
+        Relative probabilities of the figures.
+        """
+        return self.random.weights or [1] * len(self.figures)
+
     def deepcopy(self):
         return self
 
@@ -99,43 +239,378 @@ class FigureFactory:
 default_figure_factory = FigureFactory(tetris_figures, Random(len(tetris_figures)))
 
 
-@dataclass
-class Config:
-    CELL_SIZE: int = 18
-    COLS: int = 10
-    ROWS: int = 22
-    MAXFPS: int = 30
-    FIGURE_FACTORY: FigureFactory = default_figure_factory
+class GeneratedPieces:
+    """
+    Figure indices drawn from a generator of their own in batches of batch_size,
+    the last capacity of them, rounded up to whole batches, kept in a ring buffer.
+    The indices depend only on the seed, not on the global numpy random state or on the order they are asked for.
+    """
+    def __init__(
+            self, options_num: int, weights: Optional[List[float]] = None, seed: Optional[int] = None,
+            batch_size: int = 4096, capacity: int = 2 ** 16
+    ):
+        self.options_num = options_num
+        self.weights = weights
+        self.seed = np.random.SeedSequence().entropy if seed is None else seed
+        self.batch_size = batch_size
+        self._generator = np.random.default_rng(self.seed)
+        self._buffer = np.zeros(-(-max(capacity, 2 * batch_size) // batch_size) * batch_size, dtype=np.uint8)
+        self._generated_count = 0
+
+    def _draw(self, generator: np.random.Generator, size: int) -> np.ndarray:
+        if self.weights is None:
+            return generator.integers(0, self.options_num, size=size)
+        return generator.choice(self.options_num, size=size, p=np.asarray(self.weights) / sum(self.weights))
+
+    def index(self, position: int) -> int:
+        while position >= self._generated_count:
+            start = self._generated_count % len(self._buffer)
+            self._buffer[start: start + self.batch_size] = self._draw(self._generator, self.batch_size)
+            self._generated_count += self.batch_size
+        if position < self._generated_count - len(self._buffer):
+            raise IndexError(f"Piece {position} is no longer in the buffer")
+        return int(self._buffer[position % len(self._buffer)])
+
+    def head(self, length: int) -> np.ndarray:
+        """
+        The first length indices, generated again from the seed.
+        """
+        generator = np.random.default_rng(self.seed)
+        batches_count = -(-length // self.batch_size)
+        return np.concatenate(
+            [self._draw(generator, self.batch_size) for _ in range(batches_count)]
+        )[:length].astype(np.uint8)
+
+
+class StoredPieces:
+    """
+    Figure indices of a given array, possibly memory-mapped, starting over when they run out.
+    """
+    def __init__(self, indices: np.ndarray):
+        self.indices = indices
+
+    def index(self, position: int) -> int:
+        return int(self.indices[position % len(self.indices)])
+
+    def head(self, length: int) -> np.ndarray:
+        return np.resize(np.asarray(self.indices), length)
+
+
+class SequenceFigureFactory(FigureFactory):
+    """
+    Hands out the figures of a piece sequence, generated from a seed or stored in a file.
+    Copies of the factory share the sequence, each one at its own position, so searching on copies
+    of a world doesn't change the figures the world gets, and every game with the same sequence
+    gets the same figures whatever the agent does.
+    The figures are shared instances and must not be changed.
+    """
+    def __init__(
+            self, figures: List[Figure], pieces: Union[GeneratedPieces, StoredPieces], position: int = 0,
+            random: Optional[Random] = None
+    ):
+        super().__init__(figures, random or Random(len(figures), getattr(pieces, "weights", None)))
+        self.pieces = pieces
+        self.position = position
+
+    @classmethod
+    def from_seed(
+            cls, seed: Optional[int] = None, figures: List[Figure] = tetris_figures,
+            weights: Optional[List[float]] = None
+    ) -> 'SequenceFigureFactory':
+        return cls(figures, GeneratedPieces(len(figures), weights, seed))
+
+    @classmethod
+    def load(cls, path: str, figures: List[Figure] = tetris_figures) -> 'SequenceFigureFactory':
+        """
+        The sequence saved with save, memory-mapped.
+        """
+        return cls(figures, StoredPieces(np.load(path, mmap_mode='r')))
+
+    def save(self, path: str, length: int) -> None:
+        """
+        Saves the first length figures of the sequence as a .npy file.
+        """
+        np.save(path, self.pieces.head(length))
+
+    def next(self) -> Figure:
+        figure = self.figures[self.pieces.index(self.position)]
+        self.position += 1
+        return figure
+
+    def next_indices(self, size: int) -> np.ndarray:
+        """
+        The next size figures of the sequence, one game after another.
+        For every game to get the whole sequence, see the figure_sequences of BatchWorld.
+        """
+        indices = np.array([self.pieces.index(position) for position in range(self.position, self.position + size)])
+        self.position += size
+        return indices
+
+    def deepcopy(self):
+        return SequenceFigureFactory(self.figures, self.pieces, self.position, self.random)
+
+
+_zobrist_keys = {}
+_zobrist_key_lists = {}
+
+
+def zobrist_keys(rows: int, columns: int) -> np.ndarray:
+    """
+    Random 63-bit keys for every cell of a board, the same for every board of that size.
+    They don't depend on the global numpy random state and don't change it.
+    """
+    if (rows, columns) not in _zobrist_keys:
+        _zobrist_keys[rows, columns] = np.random.default_rng(rows * 1000 + columns).integers(
+            1, 2 ** 63, size=(rows, columns), dtype=np.int64
+        )
+    return _zobrist_keys[rows, columns]
+
+
+def cells_hash(keys: np.ndarray, filled_cells: np.ndarray) -> int:
+    return int(np.bitwise_xor.reduce(keys[filled_cells])) if filled_cells.any() else 0
 
 
 class Board(MapFragmentMixin):
     def __init__(self, map_fragment: np.ndarray):
         super().__init__(map_fragment)
+        self._fringe = None
+        self._hash = None
 
     @classmethod
     def clean(cls, rows, columns):
         return cls(np.zeros((rows, columns)))
 
+    @classmethod
+    def from_map_fragment(cls, map_fragment: np.ndarray):
+        return cls(map_fragment)
+
+    def fringe(self) -> List[int]:
+        """
+        Index of the topmost filled row for every column, the board height for empty columns.
+        """
+        if self._fringe is None:
+            self._fringe = kernels.fringe(self.map_fragment)
+        return self._fringe
+
+    def zobrist_hash(self) -> int:
+        """
+        XOR of the zobrist keys of the filled cells.
+        Updated incrementally when figures are fixed, recalculated after lines are removed.
+        """
+        if self._hash is None:
+            self._hash = cells_hash(zobrist_keys(self.height(), self.width()), self.map_fragment != 0)
+        return self._hash
+
     def fix_figure(self, figure: Figure, x: int, y: int) -> None:
-        self.map_fragment[y: y + figure.height(), x: x + figure.width()] += figure.map_fragment
+        region = self.map_fragment[y: y + figure.height(), x: x + figure.width()]
+        if self._hash is not None:
+            keys = zobrist_keys(self.height(), self.width())[y: y + figure.height(), x: x + figure.width()]
+            self._hash ^= cells_hash(keys, np.logical_and(region == 0, figure.map_fragment != 0))
+        region += figure.map_fragment
+        self._fringe = None
 
     def intersects(self, figure: Figure, x: int, y: int) -> bool:
         return np.any(self.map_fragment[y: y + figure.height(), x: x + figure.width()] + figure.map_fragment > 1)
 
-    def remove_full_lines(self) -> None:
+    def remove_full_lines(self) -> List[Tuple[int, np.ndarray]]:
+        """
+        Returns the removed lines as (row index, row) pairs, see restore_full_lines.
+        """
         full_lines = self.map_fragment.all(axis=1)
         full_lines_count = np.count_nonzero(full_lines)
         if not full_lines_count:
-            return
+            return []
 
+        removed_lines = [(row_index, self.map_fragment[row_index]) for row_index in np.flatnonzero(full_lines)]
         self.map_fragment = np.concatenate([
             np.zeros((full_lines_count, self.width())),
             self.map_fragment[np.where(~full_lines)],
         ], axis=0)
-        return self.remove_full_lines()
+        self._fringe = None
+        self._hash = None
+        return removed_lines
+
+    def restore_full_lines(self, removed_lines: List[Tuple[int, np.ndarray]]) -> None:
+        if not removed_lines:
+            return
+        self.map_fragment = np.insert(
+            self.map_fragment[len(removed_lines):],
+            [row_index - count for count, (row_index, _) in enumerate(removed_lines)],
+            [row for _, row in removed_lines],
+            axis=0,
+        )
+        self._fringe = None
+        self._hash = None
+
+    def copy_rows(self, start: int, stop: int) -> np.ndarray:
+        return self.map_fragment[start:stop].copy()
+
+    def restore_rows(self, start: int, rows: np.ndarray) -> None:
+        if self._hash is not None:
+            keys = zobrist_keys(self.height(), self.width())[start: start + len(rows)]
+            self._hash ^= cells_hash(keys, self.map_fragment[start: start + len(rows)] != 0)
+            self._hash ^= cells_hash(keys, rows != 0)
+        self.map_fragment[start: start + len(rows)] = rows
+        self._fringe = None
+
+    def overlaps(self, figure: Figure, x: int, y: int) -> bool:
+        return kernels.overlaps(self.map_fragment, figure.map_fragment, x, y)
 
     def deepcopy(self):
-        return Board(self.map_fragment.copy())
+        board = Board(self.map_fragment.copy())
+        board._fringe = self._fringe
+        board._hash = self._hash
+        return board
+
+
+class BitBoard:
+    """
+    Board storing every row as an integer bitmask, column i being bit i.
+    Collision tests, fixing figures and removing lines are bitwise operations.
+    map_fragment is built on demand and is read-only.
+    """
+    def __init__(self, rows: List[int], width: int):
+        self.rows = rows
+        self._width = width
+        self._full_row = (1 << width) - 1
+        self._map_fragment = None
+        self._fringe = None
+        self._hash = None
+
+    @classmethod
+    def clean(cls, rows, columns):
+        return cls([0] * rows, columns)
+
+    @classmethod
+    def from_map_fragment(cls, map_fragment: np.ndarray):
+        return cls([row_to_mask(row) for row in map_fragment], map_fragment.shape[1])
+
+    def height(self):
+        return len(self.rows)
+
+    def width(self):
+        return self._width
+
+    @property
+    def map_fragment(self) -> np.ndarray:
+        if self._map_fragment is None:
+            bits = np.asarray(self.rows, dtype=np.int64)[:, np.newaxis] >> np.arange(self._width) & 1
+            self._map_fragment = bits.astype(float)
+            self._map_fragment.flags.writeable = False
+        return self._map_fragment
+
+    def fringe(self) -> List[int]:
+        if self._fringe is None:
+            fringe = [self.height()] * self._width
+            unseen_columns = self._full_row
+            for row_index, row in enumerate(self.rows):
+                new_columns = row & unseen_columns
+                while new_columns:
+                    column_bit = new_columns & -new_columns
+                    fringe[column_bit.bit_length() - 1] = row_index
+                    new_columns ^= column_bit
+                unseen_columns &= ~row
+                if not unseen_columns:
+                    break
+            self._fringe = fringe
+        return self._fringe
+
+    def zobrist_hash(self) -> int:
+        if self._hash is None:
+            self._hash = 0
+            for row_index, row in enumerate(self.rows):
+                self._hash ^= self._row_hash(row_index, row)
+        return self._hash
+
+    def _row_hash(self, row_index: int, row: int) -> int:
+        keys = _zobrist_key_lists.get((self.height(), self._width))
+        if keys is None:
+            keys = _zobrist_key_lists[self.height(), self._width] = zobrist_keys(self.height(), self._width).tolist()
+        row_hash = 0
+        while row:
+            column_bit = row & -row
+            row_hash ^= keys[row_index][column_bit.bit_length() - 1]
+            row ^= column_bit
+        return row_hash
+
+    def fix_figure(self, figure: Figure, x: int, y: int) -> None:
+        for row_index, mask in enumerate(figure.orientation.row_masks, y):
+            if self._hash is not None:
+                self._hash ^= self._row_hash(row_index, (mask << x) & ~self.rows[row_index])
+            self.rows[row_index] |= mask << x
+        self._map_fragment = None
+        self._fringe = None
+
+    def intersects(self, figure: Figure, x: int, y: int) -> bool:
+        rows = self.rows
+        for row_index, mask in enumerate(figure.orientation.row_masks, y):
+            if rows[row_index] & (mask << x):
+                return True
+        return False
+
+    overlaps = intersects
+
+    def remove_full_lines(self) -> List[Tuple[int, int]]:
+        removed_lines = [(row_index, row) for row_index, row in enumerate(self.rows) if row == self._full_row]
+        if not removed_lines:
+            return []
+
+        self.rows = [0] * len(removed_lines) + [row for row in self.rows if row != self._full_row]
+        self._map_fragment = None
+        self._fringe = None
+        self._hash = None
+        return removed_lines
+
+    def restore_full_lines(self, removed_lines: List[Tuple[int, int]]) -> None:
+        if not removed_lines:
+            return
+        rows = self.rows[len(removed_lines):]
+        for row_index, row in removed_lines:
+            rows.insert(row_index, row)
+        self.rows = rows
+        self._map_fragment = None
+        self._fringe = None
+        self._hash = None
+
+    def copy_rows(self, start: int, stop: int) -> List[int]:
+        return self.rows[start:stop]
+
+    def restore_rows(self, start: int, rows: List[int]) -> None:
+        if self._hash is not None:
+            for row_index, row in enumerate(rows, start):
+                self._hash ^= self._row_hash(row_index, self.rows[row_index]) ^ self._row_hash(row_index, row)
+        self.rows[start: start + len(rows)] = rows
+        self._map_fragment = None
+        self._fringe = None
+
+    def deepcopy(self):
+        board = BitBoard(list(self.rows), self._width)
+        board._map_fragment = self._map_fragment
+        board._fringe = self._fringe
+        board._hash = self._hash
+        return board
+
+
+@dataclass
+class Config:
+    CELL_SIZE: int = 18
+    COLS: int = 10
+    ROWS: int = 22
+    MAXFPS: int = 30
+    FIGURE_FACTORY: FigureFactory = default_figure_factory
+    BOARD_CLASS: Type[Board] = Board
+
+
+@dataclass
+class PlacementRecord:
+    figure: Figure
+    figure_x: int
+    figure_y: int
+    next_figure: Figure
+    fixed_y: int = 0
+    fixed_rows: Any = None
+    removed_lines: Optional[List[Tuple[int, Any]]] = None
+    figure_factory_position: Optional[int] = None
 
 
 class World:
@@ -151,10 +626,16 @@ class World:
         self.figure_factory = figure_factory
 
     @classmethod
-    def from_config(cls, config: Config, figure_factory: FigureFactory = default_figure_factory):
+    def from_config(cls, config: Config, figure_factory: Optional[FigureFactory] = None):
+        """
+        Without a figure factory, a copy of the one of the config is used,
+        so all the worlds of a config with a SequenceFigureFactory get the same figures.
+        """
+        if figure_factory is None:
+            figure_factory = config.FIGURE_FACTORY.deepcopy()
         figure_x, figure_y = cls.new_figure_coordinates(config.COLS)
         return cls(
-            Board.clean(config.ROWS, config.COLS),
+            config.BOARD_CLASS.clean(config.ROWS, config.COLS),
             figure_factory.next(),
             figure_x,
             figure_y,
@@ -177,11 +658,7 @@ class World:
         ):
             return False
 
-        for row_index, row in enumerate(self.figure.map_fragment):
-            for col_index, value in enumerate(row):
-                if value and self.board.map_fragment[self.figure_y + row_index + dy, self.figure_x + col_index + dx]:
-                    return False
-        return True
+        return not self.board.overlaps(self.figure, self.figure_x + dx, self.figure_y + dy)
 
     def can_move_down(self) -> bool:
         return self._can_move_to(dy=1)
@@ -202,6 +679,15 @@ class World:
             self.switch_figure()
             return False
 
+    def drop_y(self) -> int:
+        """
+        The row where the figure gets fixed when it is moved all the way down from where it is.
+        """
+        dy = 0
+        while self._can_move_to(dy=dy + 1):
+            dy += 1
+        return self.figure_y + dy
+
     def move_all_way_down(self):
         while True:
             moved = self.move_down()
@@ -222,6 +708,68 @@ class World:
         else:
             return False
 
+    def place_figure(self, figure: Figure, x: int) -> None:
+        """
+        Rotates the current figure to the orientation of the given one, moves it to column x and drops it.
+        The result is the same as doing it step by step, but when nothing can block the rotation and the moves,
+        the landing row is found from the board fringe and the bottom profile of the figure.
+        """
+        fixed_figure, fixed_x, fixed_y = self._drop_position(figure, x)
+        self.board.fix_figure(fixed_figure, fixed_x, fixed_y)
+        self.board.remove_full_lines()
+        self.switch_figure()
+
+    def place_figure_reversibly(self, figure: Figure, x: int) -> 'PlacementRecord':
+        """
+        Same as place_figure, but returns the record that revert_placement uses to undo it.
+        A SequenceFigureFactory is rewound, so searches don't draw their pieces ahead of the games;
+        other figure factories draw from the global random state, which is not.
+        """
+        record = PlacementRecord(
+            self.figure, self.figure_x, self.figure_y, self.next_figure,
+            figure_factory_position=getattr(self.figure_factory, "position", None),
+        )
+        fixed_figure, fixed_x, record.fixed_y = self._drop_position(figure, x)
+        record.fixed_rows = self.board.copy_rows(record.fixed_y, record.fixed_y + fixed_figure.height())
+        self.board.fix_figure(fixed_figure, fixed_x, record.fixed_y)
+        record.removed_lines = self.board.remove_full_lines()
+        self.switch_figure()
+        return record
+
+    def revert_placement(self, record: 'PlacementRecord') -> None:
+        self.board.restore_full_lines(record.removed_lines)
+        self.board.restore_rows(record.fixed_y, record.fixed_rows)
+        self.figure, self.figure_x, self.figure_y = record.figure, record.figure_x, record.figure_y
+        self.next_figure = record.next_figure
+        if record.figure_factory_position is not None:
+            self.figure_factory.position = record.figure_factory_position
+
+    def _drop_position(self, figure: Figure, x: int) -> Tuple[Figure, int, int]:
+        """
+        The figure in its final orientation and the coordinates where it gets fixed.
+        """
+        fringe = self.board.fringe()
+        if (
+                0 <= x <= self.board.width() - figure.width()
+                and self.figure_x + figure.width() <= self.board.width()
+                and min(fringe) >= self.figure_y + figure.height()
+        ):
+            landing_y = min(
+                min(fringe[x + col_index] - row_index for col_index, row_index in figure.orientation.bottom_profile),
+                self.board.height() - figure.height() + 1,
+            ) - 1
+            return figure, x, landing_y
+
+        while self.figure != figure:
+            self.rotate_figure()
+        while self.figure_x > x and self.move_left():
+            pass
+        while self.figure_x < x and self.move_right():
+            pass
+        while self.can_move_down():
+            self.figure_y += 1
+        return self.figure, self.figure_x, self.figure_y
+
     def fix_figure(self):
         self.board.fix_figure(self.figure, self.figure_x, self.figure_y)
 
@@ -231,7 +779,8 @@ class World:
         self.next_figure = self.figure_factory.next()
 
     def rotate_figure(self):
-        self.figure.rotate_clockwise()
+        # figures are shared between worlds and figure factories, so the rotated one is a new figure
+        self.figure = Figure.from_orientation(self.figure.orientation.rotated)
 
     def step(self):
         self.move_down()
@@ -241,6 +790,6 @@ class World:
 
     def deepcopy(self):
         return World(
-            self.board.deepcopy(), self.figure.deepcopy(), self.figure_x, self.figure_y, self.next_figure.deepcopy(),
+            self.board.deepcopy(), self.figure, self.figure_x, self.figure_y, self.next_figure,
             self.figure_factory.deepcopy()
         )